@@ -7,19 +7,56 @@
 """
 
 import os
+import re
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import vtk
 import SimpleITK as sitk
+from vtk.util import numpy_support
 
-def applyMarchingCubes(image, threshold, transformCoord, QFormMatrix):
+PATCH_NAMES = ('inlet', 'outlet', 'wall')
+
+ENGINES = {'marchingCubes': vtk.vtkMarchingCubes,
+           'flyingEdges': vtk.vtkFlyingEdges3D,
+           'discreteFlyingEdges': vtk.vtkDiscreteFlyingEdges3D}
+
+def applyMarchingCubes(image, threshold, transformCoord, QFormMatrix, spacing=(1., 1., 1.),
+                       origin=(0., 0., 0.), engine='marchingCubes', computeNormals=False,
+                       computeGradients=False, cropComponent=True):
 
     """Wrapper function to apply vtk marching cubes algorithm. If transformCoord ==True applies vtk transform filter for alignment between vtkImageData and vtkPolyData. More info: https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/nifti1fields_pages/qsform.html
 
     Parameters
     ----------
-    image: vtkImage
-        vtkImage from vtkNIFTIImageReader
+    image: vtkImage or array
+        vtkImage from vtkNIFTIImageReader, or numpy label array in (z, y, x) order (see
+        arrayToVTK).
     threshold: float
         threshold for binarization purposes
+    transformCoord: bool
+        Whether to transform the surface with QFormMatrix.
+    QFormMatrix: vtkMatrix or array
+        NIfTI QForm matrix (4x4, RAS coordinates) from readImage or a numpy array. It is not
+        modified.
+    spacing: tuple
+        (x, y, z) voxel spacing of a numpy image.
+    origin: tuple
+        (x, y, z) origin of a numpy image.
+    engine: string
+        Isosurface filter: 'marchingCubes' (vtkMarchingCubes, serial), 'flyingEdges'
+        (vtkFlyingEdges3D, multithreaded) or 'discreteFlyingEdges' (vtkDiscreteFlyingEdges3D,
+        multithreaded boundary of the voxels labelled threshold, e.g. 2 for the pores of a
+        two-class Atropos segmentation).
+    computeNormals: bool
+        Whether to compute the point normals (the smoothing and the STL do not use them).
+    computeGradients: bool
+        Whether to compute the point gradients.
+    cropComponent: bool
+        Contour only the bounding box of the largest connected component of the voxels above
+        threshold (see cropLargestComponent), instead of triangulating every small disconnected
+        region before getLargestRegion. The component is chosen by voxel count, while
+        getLargestRegion (still applied) keeps the region with the most triangles, so on noisy
+        samples the result can differ from cropComponent=False.
 
     Returns
     -------
@@ -29,19 +66,30 @@ def applyMarchingCubes(image, threshold, transformCoord, QFormMatrix):
     """
     contourNumber = 0
 
-    marchingCubes = vtk.vtkMarchingCubes()
+    if engine not in ENGINES:
+        raise ValueError('engine must be one of %s.' % ', '.join(ENGINES))
+
+    if not isinstance(image, np.ndarray) and cropComponent:
+        spacing, origin = image.GetSpacing(), image.GetOrigin()
+        image = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(
+                    image.GetDimensions()[::-1])
+    if isinstance(image, np.ndarray):
+        if cropComponent:
+            image, offset = cropLargestComponent(image, threshold,
+                                                 discrete=engine=='discreteFlyingEdges')
+            origin = [o + i*s for o, i, s in zip(origin, offset, spacing)]
+        image = arrayToVTK(image, spacing, origin)
+
+    marchingCubes = ENGINES[engine]()
     marchingCubes.SetInputData(image)
-    marchingCubes.ComputeNormalsOn()
-    marchingCubes.ComputeGradientsOn()
+    marchingCubes.SetComputeNormals(computeNormals)
+    marchingCubes.SetComputeGradients(computeGradients)
     marchingCubes.SetValue(contourNumber, threshold)
     marchingCubes.Update()
     
     if transformCoord==True:
-        for i in range(2):
-            for j in [0,1,2,3]:
-                QFormMatrix.SetElement(i,j,-QFormMatrix.GetElement(i,j))
         transform = vtk.vtkTransform()
-        transform.SetMatrix(QFormMatrix)
+        transform.SetMatrix(createLPSMatrix(QFormMatrix))
         transform.Update()
 
         transformPoly = vtk.vtkTransformPolyDataFilter()
@@ -58,6 +106,117 @@ def applyMarchingCubes(image, threshold, transformCoord, QFormMatrix):
     return largestRegion
 
 
+def cropLargestComponent(array, threshold, discrete=False):
+
+    """Crop a segmentation to the bounding box (with a margin of one voxel) of the largest
+    connected component of the voxels above threshold. The voxels of the other components inside
+    the box are set below threshold. The components are 26-connected, so no marching cubes cell
+    holds voxels of two components and the surface of the largest component is not changed. The
+    largest component is the one with the most voxels, which is not necessarily the surface region
+    with the most triangles.
+
+    Parameters
+    ----------
+    array: array
+        3D image in (z, y, x) order.
+    threshold: float
+        threshold for binarization purposes
+    discrete: bool
+        Use the voxels equal to threshold (a label), as vtkDiscreteFlyingEdges3D.
+
+    Returns
+    -------
+    croppedArray: array
+        Copy of the bounding box of the largest component.
+    offset: tuple
+        (x, y, z) index of the first voxel of croppedArray in array.
+
+    """
+
+    foreground = array == threshold if discrete else array > threshold
+    components = sitk.ConnectedComponent(sitk.GetImageFromArray(foreground.astype(np.uint8)), True)
+    # Sorted by voxel count: the largest component is labelled 1
+    components = sitk.GetArrayFromImage(sitk.RelabelComponent(components, sortByObjectSize=True))
+    if components.max() == 0:
+        return array, (0, 0, 0)
+
+    largestComponent = components == 1
+    bounds = []
+    for axis in range(3):
+        otherAxes = tuple(other for other in range(3) if other != axis)
+        indices = np.flatnonzero(largestComponent.any(axis=otherAxes))
+        bounds.append(slice(max(indices[0]-1, 0), min(indices[-1]+2, array.shape[axis])))
+    bounds = tuple(bounds)
+
+    croppedArray = array[bounds].copy()
+    otherComponents = components[bounds] > 1
+    if discrete:
+        croppedArray[otherComponents] = threshold + 1
+    else:
+        croppedArray[otherComponents] = array.min()
+
+    return croppedArray, tuple(bound.start for bound in reversed(bounds))
+
+def createLPSMatrix(QFormMatrix):
+
+    """Transform from the image coordinates to the LPS coordinates of ITK, flipping the first two
+    rows of the (RAS) QForm matrix.
+
+    Parameters
+    ----------
+    QFormMatrix: vtkMatrix or array
+        NIfTI QForm matrix (4x4), it is not modified.
+
+    Returns
+    -------
+    LPSMatrix: vtkMatrix
+        New 4x4 matrix for vtkTransform.
+
+    """
+
+    if isinstance(QFormMatrix, vtk.vtkMatrix4x4):
+        QFormMatrix = [[QFormMatrix.GetElement(i, j) for j in range(4)] for i in range(4)]
+    LPSMatrix = np.diag([-1., -1., 1., 1.]) @ np.asarray(QFormMatrix, dtype=float)
+
+    matrix = vtk.vtkMatrix4x4()
+    matrix.DeepCopy(LPSMatrix.ravel())
+
+    return matrix
+
+def arrayToVTK(array, spacing=(1., 1., 1.), origin=(0., 0., 0.)):
+
+    """Wrap a numpy image as vtkImageData without copying its voxels (a copy is only made if the
+    array is not C-contiguous or is boolean).
+
+    Parameters
+    ----------
+    array: array
+        3D image in (z, y, x) order, as from sitk.GetArrayViewFromImage.
+    spacing: tuple
+        (x, y, z) voxel spacing.
+    origin: tuple
+        (x, y, z) origin. With a QForm transform use the default zero origin, as from
+        vtkNIFTIImageReader.
+
+    Returns
+    -------
+    image: vtkImageData
+        Image sharing the buffer of array (the vtk array keeps a reference to it).
+
+    """
+
+    if array.dtype == bool:
+        array = array.view(np.uint8)
+    array = np.ascontiguousarray(array)
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[::-1])
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.reshape(-1), deep=False))
+
+    return image
+
 def getLargestRegion(poly):
 
     """Function to get largest connected region from vtk poly data.
@@ -83,7 +242,8 @@ def getLargestRegion(poly):
     
     return largestRegion
 
-def applyPolyFilter(poly):
+def applyPolyFilter(poly, numberOfIterations=100, passBand=0.25, featureAngle=120.0,
+                    checkInterval=None, tolerance=5e-3, maxShrinkage=None, numberOfWorkers=1):
 
     """Function that apply a surface vtk poly data filter. 
 
@@ -91,6 +251,24 @@ def applyPolyFilter(poly):
     ----------
     poly: vtkPolyData
         vtk data object that represents a geometric structure with vertices, lines, polygons...
+    numberOfIterations: int
+        Number of iterations of the windowed sinc filter (maximum number with checkInterval).
+    passBand: float
+        Pass band of the windowed sinc filter.
+    featureAngle: float
+        Feature angle in degrees.
+    checkInterval: int
+        If given, the filter runs in passes of checkInterval iterations, each one smoothing the
+        output of the previous one, and stops when the relative change of the volume and of the
+        area (from vtkMassProperties) in a pass is below tolerance (see smoothSurface).
+    tolerance: float
+        Relative change of volume and area per pass below which the smoothing stops.
+    maxShrinkage: float
+        Maximum relative volume loss with checkInterval (e.g. 0.02), the pass exceeding it is
+        discarded and the smoothing stops.
+    numberOfWorkers: int
+        Number of threads smoothing the connected regions of poly at the same time (the regions
+        are smoothed independently in any case).
 
     Returns
     -------
@@ -104,10 +282,68 @@ def applyPolyFilter(poly):
     #-First, I would consider a higher passBand (e. g., 0.3, 0.4, 0.5, etc...).
     #-Second, with a different passBand, I would increase the numberOfIterations
     #and gradually decrease that number (but never going less than 100 iterations).
-    numberOfIterations = 100
-    passBand = 0.25
-    featureAngle = 120.0
-    
+    #Instead of re-running the filter by hand, checkInterval and maxShrinkage stop it when the
+    #surface converges or before it shrinks too much.
+    smoothParameters = dict(numberOfIterations=numberOfIterations, passBand=passBand,
+                            featureAngle=featureAngle, checkInterval=checkInterval,
+                            tolerance=tolerance, maxShrinkage=maxShrinkage)
+    if numberOfWorkers == 1:
+        return smoothSurface(poly, **smoothParameters)
+
+    regions = splitRegions(poly)
+    with ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+        # The largest regions first, so that they do not end the pool alone
+        regions.sort(key=lambda region: -region.GetNumberOfCells())
+        smoothRegions = list(executor.map(lambda region: smoothSurface(region, **smoothParameters),
+                                          regions))
+
+    appendFilter = vtk.vtkAppendPolyData()
+    for smoothRegion in smoothRegions:
+        appendFilter.AddInputData(smoothRegion)
+    appendFilter.Update()
+
+    smoothPoly = appendFilter.GetOutput()
+    return smoothPoly
+
+def smoothSurface(poly, numberOfIterations=100, passBand=0.25, featureAngle=120.0,
+                  checkInterval=None, tolerance=5e-3, maxShrinkage=None):
+
+    """vtkWindowedSincPolyDataFilter of one surface, in a single run or in passes of
+    checkInterval iterations monitored with vtkMassProperties. Note that a pass is a windowed sinc
+    filter of checkInterval iterations applied to the previous output, so passes of 20 iterations
+    do not give the same surface as one run of 100 iterations (see applyPolyFilter for the
+    parameters).
+
+    Returns
+    -------
+    smoothPoly: vtkPolyData
+        smooth surface from poly input
+
+    """
+
+    if checkInterval is None:
+        return windowedSinc(poly, numberOfIterations, passBand, featureAngle)
+
+    initialVolume, area = getMassProperties(poly)
+    volume = initialVolume
+    smoothPoly = poly
+    for _ in range(0, numberOfIterations, checkInterval):
+        passPoly = windowedSinc(smoothPoly, checkInterval, passBand, featureAngle)
+        passVolume, passArea = getMassProperties(passPoly)
+
+        if maxShrinkage is not None and initialVolume - passVolume > maxShrinkage * initialVolume:
+            break
+        change = max(abs(passVolume - volume) / volume, abs(passArea - area) / area)
+        smoothPoly, volume, area = passPoly, passVolume, passArea
+        if change < tolerance:
+            break
+
+    return smoothPoly
+
+def windowedSinc(poly, numberOfIterations, passBand, featureAngle):
+
+    """Wrapper of vtkWindowedSincPolyDataFilter."""
+
     polyFilter = vtk.vtkWindowedSincPolyDataFilter()
     polyFilter.SetInputData(poly)
     polyFilter.SetNumberOfIterations(numberOfIterations)
@@ -118,6 +354,341 @@ def applyPolyFilter(poly):
     smoothPoly = polyFilter.GetOutput()
     return smoothPoly
 
+def getMassProperties(poly):
+
+    """Volume and area of a triangle surface from vtkMassProperties (the volume is only
+    meaningful for a closed surface, it is used here to measure the shrinkage).
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        Triangle surface.
+
+    Returns
+    -------
+    volume: float
+        Enclosed volume.
+    area: float
+        Surface area.
+
+    """
+
+    massProperties = vtk.vtkMassProperties()
+    massProperties.SetInputData(poly)
+    massProperties.Update()
+
+    return massProperties.GetVolume(), massProperties.GetSurfaceArea()
+
+def splitRegions(poly):
+
+    """Split a surface in its connected regions.
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        vtk data object that represents a geometric structure with vertices, lines, polygons...
+
+    Returns
+    -------
+    regions: list
+        vtkPolyData of each connected region, without the points of the other regions.
+
+    """
+
+    connectivityFilter = vtk.vtkPolyDataConnectivityFilter()
+    connectivityFilter.SetInputData(poly)
+    connectivityFilter.SetExtractionModeToAllRegions()
+    connectivityFilter.Update()
+    numberOfRegions = connectivityFilter.GetNumberOfExtractedRegions()
+
+    connectivityFilter.SetExtractionModeToSpecifiedRegions()
+    regions = []
+    for regionId in range(numberOfRegions):
+        connectivityFilter.InitializeSpecifiedRegionList()
+        connectivityFilter.AddSpecifiedRegion(regionId)
+        cleanFilter = vtk.vtkCleanPolyData()
+        cleanFilter.SetInputConnection(connectivityFilter.GetOutputPort())
+        cleanFilter.PointMergingOff()
+        cleanFilter.Update()
+        regions.append(cleanFilter.GetOutput())
+
+    return regions
+
+def applyDecimation(poly, targetReduction=None, targetEdgeLength=None, featureAngle=60.0):
+
+    """Reduce the number of triangles with vtkDecimatePro, keeping the topology, the feature edges
+    and the open boundaries (inlet and outlet) of the surface.
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        vtk data object that represents a geometric structure with vertices, lines, polygons...
+    targetReduction: float
+        Fraction of the triangles to remove (e.g. 0.9 keeps 10% of them).
+    targetEdgeLength: float
+        Alternative to targetReduction: mean edge length of the decimated surface, in the units
+        of poly (see readCellSize). The number of triangles scales with the inverse square of the
+        edge length. The surface is not refined if its edges are already longer.
+    featureAngle: float
+        Feature angle in degrees, edges sharper than it are kept.
+
+    Returns
+    -------
+    decimatedPoly: vtkPolyData
+        decimated surface from poly input
+
+    """
+
+    if (targetReduction is None) == (targetEdgeLength is None):
+        raise ValueError('Give either targetReduction or targetEdgeLength.')
+    if targetReduction is None:
+        meanEdgeLength = getMeanEdgeLength(poly)
+        targetReduction = min(max(1 - (meanEdgeLength/targetEdgeLength)**2, 0.), 0.99)
+
+    decimationFilter = vtk.vtkDecimatePro()
+    decimationFilter.SetInputData(poly)
+    decimationFilter.SetTargetReduction(targetReduction)
+    decimationFilter.PreserveTopologyOn()
+    decimationFilter.SetFeatureAngle(featureAngle)
+    decimationFilter.BoundaryVertexDeletionOff()
+    decimationFilter.Update()
+
+    decimatedPoly = decimationFilter.GetOutput()
+
+    return decimatedPoly
+
+def splitPatches(poly, axis=None, clipDistance=None, inletAtMin=True):
+
+    """Clip the surface with two planes near the ends of the core and label its triangles as
+    inlet, outlet or wall (the PATCH_NAMES indices, in the 'patch' cell array read by writeFMS
+    and extractPatch). The planes are normal to an axis of the (QForm transformed) bounding box,
+    and the clipped surface is closed with plane faces at the core ends.
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        Surface of the wormhole, closed or open at the core ends.
+    axis: int
+        Flow axis (0, 1 or 2 for x, y or z), default the longest axis of the bounding box.
+    clipDistance: float
+        Distance between the planes and the ends of the bounding box, default twice the mean edge
+        length (it removes the open or irregular rims at the image borders).
+    inletAtMin: bool
+        Whether the inlet is the end with the smallest coordinate along axis.
+
+    Returns
+    -------
+    patchedPoly: vtkPolyData
+        Closed surface with the 'patch' cell array.
+
+    """
+
+    triangles = numpy_support.vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    usedPoints = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())[np.unique(triangles)]
+    # Bounds of the points of the triangles: poly.GetBounds() also counts the unused points, e.g.
+    # the ones of the regions discarded by getLargestRegion
+    bounds = np.stack([usedPoints.min(axis=0), usedPoints.max(axis=0)], axis=1)
+    if axis is None:
+        axis = int(np.argmax(bounds[:, 1] - bounds[:, 0]))
+    if clipDistance is None:
+        clipDistance = 2 * getMeanEdgeLength(poly)
+    ends = [bounds[axis, 0] + clipDistance, bounds[axis, 1] - clipDistance]
+
+    # vtkClipClosedSurface only closes outward oriented surfaces, and a QForm transform with a
+    # negative determinant turns the marching cubes triangles inside out
+    if getSignedVolume(poly) < 0:
+        reverseFilter = vtk.vtkReverseSense()
+        reverseFilter.SetInputData(poly)
+        reverseFilter.ReverseCellsOn()
+        reverseFilter.Update()
+        poly = reverseFilter.GetOutput()
+
+    planes = vtk.vtkPlaneCollection()
+    for end, direction in zip(ends, [1, -1]):
+        origin, normal = [0., 0., 0.], [0., 0., 0.]
+        origin[axis], normal[axis] = end, direction
+        plane = vtk.vtkPlane()
+        plane.SetOrigin(origin)
+        plane.SetNormal(normal)
+        planes.AddItem(plane)
+
+    clipFilter = vtk.vtkClipClosedSurface()
+    clipFilter.SetInputData(poly)
+    clipFilter.SetClippingPlanes(planes)
+    clipFilter.Update()
+    patchedPoly = clipFilter.GetOutput()
+    if not patchedPoly.GetPolys().IsHomogeneous() == 3:
+        triangleFilter = vtk.vtkTriangleFilter()
+        triangleFilter.SetInputData(patchedPoly)
+        triangleFilter.Update()
+        patchedPoly = triangleFilter.GetOutput()
+
+    # A triangle is on an end face if its three vertices are on the plane
+    points = numpy_support.vtk_to_numpy(patchedPoly.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(patchedPoly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    coordinates = points[triangles, axis]
+    tolerance = 1e-6 * (bounds[axis, 1] - bounds[axis, 0])
+    minEnd = np.all(np.abs(coordinates - ends[0]) <= tolerance, axis=1)
+    maxEnd = np.all(np.abs(coordinates - ends[1]) <= tolerance, axis=1)
+
+    patches = np.full(len(triangles), PATCH_NAMES.index('wall'), dtype=np.int32)
+    patches[minEnd] = PATCH_NAMES.index('inlet' if inletAtMin else 'outlet')
+    patches[maxEnd] = PATCH_NAMES.index('outlet' if inletAtMin else 'inlet')
+
+    patchArray = numpy_support.numpy_to_vtk(patches, deep=True)
+    patchArray.SetName('patch')
+    patchedPoly.GetCellData().AddArray(patchArray)
+
+    return patchedPoly
+
+def getSignedVolume(poly):
+
+    """Volume enclosed by a triangle surface, negative if its triangles are oriented inwards (with
+    the divergence theorem, relative to the center of the points of the triangles so that it is
+    meaningful for a surface with small holes).
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        Triangle surface.
+
+    Returns
+    -------
+    signedVolume: float
+        Signed enclosed volume.
+
+    """
+
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData()).astype(float)
+    triangles = numpy_support.vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    # Center of the points of the triangles only (see splitPatches)
+    points -= points[np.unique(triangles)].mean(axis=0)
+    vertices = points[triangles]
+
+    return float(np.einsum('ij,ij->', vertices[:, 0], np.cross(vertices[:, 1], vertices[:, 2]))) / 6
+
+def extractPatch(poly, patchName, patchArrayName='patch'):
+
+    """Triangles of one patch of a surface labelled by splitPatches.
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        Surface with the patch cell array.
+    patchName: string
+        One of PATCH_NAMES.
+    patchArrayName: string
+        Cell array with the patch index of each triangle.
+
+    Returns
+    -------
+    patchPoly: vtkPolyData
+        Surface of the patch, without the points of the other patches.
+
+    """
+
+    patches = numpy_support.vtk_to_numpy(poly.GetCellData().GetArray(patchArrayName))
+    triangles = numpy_support.vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    patchTriangles = triangles[patches == PATCH_NAMES.index(patchName)]
+
+    # Renumber the points used by the patch
+    usedPoints, patchTriangles = np.unique(patchTriangles, return_inverse=True)
+    patchTriangles = patchTriangles.reshape(-1, 3)
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())[usedPoints]
+
+    patchPoints = vtk.vtkPoints()
+    patchPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    cells = vtk.vtkCellArray()
+    offsets = np.arange(0, 3*len(patchTriangles)+1, 3, dtype=np.int64)
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(patchTriangles.reshape(-1).astype(np.int64),
+                                                        deep=True))
+
+    patchPoly = vtk.vtkPolyData()
+    patchPoly.SetPoints(patchPoints)
+    patchPoly.SetPolys(cells)
+
+    return patchPoly
+
+def writePatches(path, name, poly, binary=True):
+
+    """Write one STL for each patch of a surface labelled by splitPatches, named name_inlet.stl,
+    name_outlet.stl and name_wall.stl.
+
+    Parameters
+    ----------
+    path: string
+        String containing a path to the data directory
+    name: string
+        String containing the data or sample name, without extension
+    poly: vtkPolyData
+        Surface with the patch cell array.
+    binary: bool
+        Binary STL.
+
+    """
+
+    for patchName in PATCH_NAMES:
+        writeSTL(path, name+'_'+patchName+'.stl', extractPatch(poly, patchName), binary)
+
+def getMeanEdgeLength(poly):
+
+    """Mean edge length of a triangle surface (each edge is counted once per triangle).
+
+    Parameters
+    ----------
+    poly: vtkPolyData
+        Triangle surface.
+
+    Returns
+    -------
+    meanEdgeLength: float
+        Mean edge length in the units of poly.
+
+    """
+
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    vertices = points[triangles]
+    edges = vertices - np.roll(vertices, 1, axis=1)
+
+    return float(np.linalg.norm(edges, axis=2).mean())
+
+def readCellSize(meshDictPath, unitScale=1.):
+
+    """Finest boundary cell size of a cfMesh meshDict: maxCellSize divided by 2 to the largest
+    additionalRefinementLevels of its surfaceMeshRefinement (cfMesh counts the levels from
+    maxCellSize), or boundaryCellSize if it is smaller.
+
+    Parameters
+    ----------
+    meshDictPath: string
+        Path to the meshDict file (e.g. OpenFOAM/sampleA/system/meshDict).
+    unitScale: float
+        Surface units per meshDict unit (e.g. 1000 for a surface in mm and a mesh in m).
+
+    Returns
+    -------
+    cellSize: float
+        Finest boundary cell size in the units of the surface.
+
+    """
+
+    with open(meshDictPath) as f:
+        # Without the comments
+        meshDict = re.sub(r'//.*', '', re.sub(r'/\*.*?\*/', '', f.read(), flags=re.S))
+
+    maxCellSize = float(re.search(r'\bmaxCellSize\s+([^;\s]+)\s*;', meshDict).group(1))
+    levels = [int(level) for level in re.findall(r'\badditionalRefinementLevels\s+(\d+)\s*;',
+                                                  meshDict)]
+    cellSize = maxCellSize / 2**max(levels, default=0)
+
+    boundaryCellSize = re.search(r'\bboundaryCellSize\s+([^;\s]+)\s*;', meshDict)
+    if boundaryCellSize is not None:
+        cellSize = min(cellSize, float(boundaryCellSize.group(1)))
+
+    return unitScale * cellSize
+
 def readImage(path, name):
 
     """vtkNIFTI image reader wrapper function.
@@ -146,7 +717,7 @@ def readImage(path, name):
 
     return image, QFormMatrix
 
-def writeSTL(path, name, poly):
+def writeSTL(path, name, poly, binary=True):
 
     """STL writting function for vtkPolyData.
 
@@ -158,14 +729,98 @@ def writeSTL(path, name, poly):
         String containing the data or sample name
     poly: vtkPolyData
         vtk data object that represents a geometric structure with vertices, lines, polygons...
+    binary: bool
+        Binary STL (about 5 times smaller and faster to read than ASCII).
 
     """
 
     writer = vtk.vtkSTLWriter()
     writer.SetInputData(poly)
     writer.SetFileName(path+name)
+    if binary:
+        writer.SetFileTypeToBinary()
+    else:
+        writer.SetFileTypeToASCII()
     writer.Update()
 
+def writeVTP(path, name, poly, compressionLevel=5):
+
+    """Compressed VTK XML (.vtp) writting function for vtkPolyData, which keeps the point and cell
+    arrays (e.g. the patch of each triangle).
+
+    Parameters
+    ----------
+    path: string
+        String containing a path to the data directory
+    name: string
+        String containing the data or sample name
+    poly: vtkPolyData
+        vtk data object that represents a geometric structure with vertices, lines, polygons...
+    compressionLevel: int
+        zlib compression level, from 1 (fastest) to 9 (smallest).
+
+    """
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(poly)
+    writer.SetFileName(path+name)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToZLib()
+    writer.SetCompressionLevel(compressionLevel)
+    writer.Write()
+
+def writeFMS(path, name, poly, patchNames=('wall',), patchTypes=None, patchArrayName='patch'):
+
+    """cfMesh surface (.fms) writting function for vtkPolyData, read by the surfaceFile of
+    meshDict without the conversion of an STL.
+
+    Parameters
+    ----------
+    path: string
+        String containing a path to the data directory
+    name: string
+        String containing the data or sample name
+    poly: vtkPolyData
+        Triangle surface.
+    patchNames: tuple
+        Name of each patch, e.g. ('inlet', 'outlet', 'wall').
+    patchTypes: tuple
+        Geometric type of each patch (default: 'wall' for a patch named wall, 'patch' otherwise).
+    patchArrayName: string
+        Cell array with the patch index of each triangle. Without it every triangle is in the
+        first patch.
+
+    """
+
+    if patchTypes is None:
+        patchTypes = ['wall' if patchName == 'wall' else 'patch' for patchName in patchNames]
+
+    if not poly.GetPolys().IsHomogeneous() == 3:
+        triangleFilter = vtk.vtkTriangleFilter()
+        triangleFilter.SetInputData(poly)
+        triangleFilter.Update()
+        poly = triangleFilter.GetOutput()
+
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    patchArray = poly.GetCellData().GetArray(patchArrayName)
+    if patchArray is None:
+        patches = np.zeros(len(triangles), dtype=int)
+    else:
+        patches = numpy_support.vtk_to_numpy(patchArray)
+
+    with open(path+name, 'w') as f:
+        f.write('%d\n(\n' % len(patchNames))
+        for patchName, patchType in zip(patchNames, patchTypes):
+            f.write('%s %s\n' % (patchName, patchType))
+        f.write(')\n\n%d\n(\n' % len(points))
+        np.savetxt(f, points, fmt='(%.9g %.9g %.9g)')
+        f.write(')\n\n%d\n(\n' % len(triangles))
+        np.savetxt(f, np.column_stack([triangles, patches]), fmt='((%d %d %d) %d)')
+        # No feature edges and no point, facet and edge subsets
+        f.write(')\n\n0\n()\n\n0\n()\n\n0\n()\n\n0\n()\n')
+
 if __name__=='__main__':
     
     sample = 'testSample'
@@ -174,6 +829,11 @@ if __name__=='__main__':
     inputName = '/'+sample+'_segmentation.nii.gz'
     cubesOutputName = '/cubes_'+sample+'.stl'
     smoothOutputName = '/smooth_'+sample+'.stl'
+    decimatedOutputName = '/decimated_'+sample+'.stl'
+    fmsOutputName = '/'+sample+'.fms'
+    patchOutputName = '/patch_'+sample
+    # The surface does not need edges much shorter than the cells of cfMesh
+    meshDictPath = os.path.abspath('/wormholeCFD/OpenFOAM/sampleA/system/meshDict')
 
     threshold = 1.5
     transformCoord=True
@@ -187,3 +847,18 @@ if __name__=='__main__':
     writeSTL(outputPath,cubesOutputName, mcPoly)
 
     writeSTL(outputPath,smoothOutputName, polyFiltered)
+
+    # The surface is in mm and the meshDict in m
+    cellSize = readCellSize(meshDictPath, unitScale=1e3)
+    polyDecimated = applyDecimation(polyFiltered, targetEdgeLength=cellSize)
+    print('Decimation to %.4g mm edges: %d -> %d triangles (%.1f%% reduction)' %
+          (cellSize, polyFiltered.GetNumberOfCells(), polyDecimated.GetNumberOfCells(),
+           100 * (1 - polyDecimated.GetNumberOfCells() / max(polyFiltered.GetNumberOfCells(), 1))))
+
+    writeSTL(outputPath,decimatedOutputName, polyDecimated)
+
+    polyPatched = splitPatches(polyDecimated)
+
+    writePatches(outputPath, patchOutputName, polyPatched)
+
+    writeFMS(outputPath, fmsOutputName, polyPatched, PATCH_NAMES)
@@ -6,9 +6,13 @@
 """
 
 import os
+import math
+import numpy as np
 import SimpleITK as sitk
+from runtimeConfig import timedStage
 
-def shrinkBiasCorrection(inputImage):
+@timedStage('biasCorrection')
+def shrinkBiasCorrection(inputImage, shrinkFactor=4, coarseBias=False, slabSize=32):
 
     """Bias field correction with shrinking operation.
 
@@ -16,6 +20,14 @@ def shrinkBiasCorrection(inputImage):
     -----------
     inputImage: sitkImage
         We expect an sitkImage from sitk.ReadImage.
+    shrinkFactor: int
+        Integer factor of the image shrinking before the bias estimation.
+    coarseBias: bool
+        Return the bias field sampled on a grid shrinked by shrinkFactor (see createCoarseGrid)
+        instead of the full resolution one. The bias is then upsampled slab by slab while it is
+        applied, so no full resolution float image is created (use upsampleBias to get it).
+    slabSize: int
+        Number of slices corrected at a time (see applyBias).
 
     Returns
     --------
@@ -26,21 +38,264 @@ def shrinkBiasCorrection(inputImage):
 
     """
 
-    shrinkFactor = 4 # Must be a integer factor
-
     # Using sitk.Shrink reduces the processing time and gives good results
     shrinkedImage = sitk.Shrink(inputImage, [shrinkFactor]*inputImage.GetDimension())
     
     biasFilter = sitk.N4BiasFieldCorrectionImageFilter()
     shrinkedImageWithoutBias = biasFilter.Execute(sitk.Cast(shrinkedImage, sitk.sitkFloat32))
-    bias = biasFilter.GetLogBiasFieldAsImage(inputImage)
+    if coarseBias:
+        bias = biasFilter.GetLogBiasFieldAsImage(createCoarseGrid(inputImage, shrinkFactor))
+    else:
+        bias = biasFilter.GetLogBiasFieldAsImage(inputImage)
     
-    dataWithoutBias = sitk.Cast(sitk.Cast(inputImage, sitk.sitkFloat32)/sitk.Exp(bias),
-                        sitk.sitkInt16)
+    dataWithoutBias = applyBias(inputImage, bias, slabSize)
 
     return dataWithoutBias, bias
 
 
+@timedStage('biasCorrection')
+def multiLevelBiasCorrection(inputImage, shrinkFactors=(8, 4, 2), numberOfIterations=(50, 25, 10),
+                             convergenceThreshold=0.001, maskImage=None, numberOfFittingLevels=4,
+                             fullResolutionBias=True, slabSize=32):
+
+    """Multi-resolution N4 bias field correction. Each level fits the residual bias of the image
+    corrected by the previous levels, shrinked by the level factor, so most iterations run on the
+    smallest images. The bias is accumulated on a coarse grid only, and it is evaluated at full
+    resolution once, while it is applied.
+
+    Parameters
+    -----------
+    inputImage: sitkImage
+        We expect an sitkImage from sitk.ReadImage.
+    shrinkFactors: tuple
+        Integer shrink factor of each level, from the coarsest to the finest.
+    numberOfIterations: tuple
+        Maximum number of iterations of each level (for each B-spline fitting level).
+    convergenceThreshold: float
+        N4 convergence threshold of every level.
+    maskImage: sitkImage
+        Optional foreground mask (e.g. from createForegroundMask), the background voxels are not
+        used to fit the bias.
+    numberOfFittingLevels: int
+        Number of B-spline fitting levels of N4.
+    fullResolutionBias: bool
+        Also return the bias at the resolution of inputImage. Otherwise it is upsampled slab by
+        slab while it is applied, and bias is None.
+    slabSize: int
+        Number of slices corrected at a time (see applyBias).
+
+    Returns
+    --------
+    dataWithoutBias: sitkImage
+        Reconstructed data (not shrinked) without bias.
+    bias: sitkImage
+        The removed bias field (log bias, as in shrinkBiasCorrection), None without
+        fullResolutionBias.
+    coarseBias: sitkImage
+        The removed bias field sampled on a grid shrinked by the finest factor, for applyCoarseBias.
+
+    """
+
+    # The bias is evaluated on a coarse grid with the same extent as the image (first and last
+    # voxel centers), since N4 spreads its B-spline lattice over the extent of the given image.
+    coarseGrid = createCoarseGrid(inputImage, shrinkFactors[-1])
+
+    coarseBias = None
+    for shrinkFactor, iterations in zip(shrinkFactors, numberOfIterations):
+        shrinkedImage = sitk.Cast(sitk.Shrink(inputImage, [shrinkFactor]*inputImage.GetDimension()),
+                                  sitk.sitkFloat32)
+        if coarseBias is not None:
+            # Correct the level input with the bias of the previous levels on its own grid
+            shrinkedBias = sitk.Resample(coarseBias, shrinkedImage, sitk.Transform(),
+                                         sitk.sitkBSpline, 0., sitk.sitkFloat32, True)
+            shrinkedImage = shrinkedImage/sitk.Exp(shrinkedBias)
+
+        biasFilter = sitk.N4BiasFieldCorrectionImageFilter()
+        biasFilter.SetMaximumNumberOfIterations([iterations]*numberOfFittingLevels)
+        biasFilter.SetConvergenceThreshold(convergenceThreshold)
+        if maskImage is None:
+            biasFilter.Execute(shrinkedImage)
+        else:
+            shrinkedMask = sitk.Shrink(maskImage, [shrinkFactor]*inputImage.GetDimension())
+            biasFilter.Execute(shrinkedImage, sitk.Cast(shrinkedMask, sitk.sitkUInt8))
+
+        levelCoarseBias = biasFilter.GetLogBiasFieldAsImage(coarseGrid)
+        coarseBias = levelCoarseBias if coarseBias is None else coarseBias + levelCoarseBias
+
+    del shrinkedImage
+    if fullResolutionBias:
+        bias = upsampleBias(coarseBias, inputImage)
+        dataWithoutBias = applyBias(inputImage, bias, slabSize)
+    else:
+        bias = None
+        dataWithoutBias = applyBias(inputImage, coarseBias, slabSize)
+
+    return dataWithoutBias, bias, coarseBias
+
+def createCoarseGrid(inputImage, shrinkFactor):
+
+    """Image grid with about shrinkFactor times less voxels along each axis than inputImage, and
+    the same first and last voxel centers.
+
+    Parameters
+    -----------
+    inputImage: sitkImage
+        Reference image.
+    shrinkFactor: int
+        Integer shrink factor.
+
+    Returns
+    --------
+    grid: sitkImage
+        Empty image with the coarse grid.
+
+    """
+
+    size = [int(math.ceil((n - 1) / shrinkFactor)) + 1 for n in inputImage.GetSize()]
+    spacing = [s * (n - 1) / (m - 1) if m > 1 else s * shrinkFactor
+               for s, n, m in zip(inputImage.GetSpacing(), inputImage.GetSize(), size)]
+
+    grid = sitk.Image(size, sitk.sitkFloat32)
+    grid.SetOrigin(inputImage.GetOrigin())
+    grid.SetSpacing(spacing)
+    grid.SetDirection(inputImage.GetDirection())
+
+    return grid
+
+@timedStage('biasCorrection')
+def applyCoarseBias(inputImage, coarseBias, slabSize=32):
+
+    """Re-apply a bias field saved by multiLevelBiasCorrection, e.g. to a repeat scan of the same
+    sample, without fitting it again. The bias is interpolated with cubic B-splines in physical
+    coordinates.
+
+    Parameters
+    -----------
+    inputImage: sitkImage
+        Image to correct.
+    coarseBias: sitkImage
+        Coarse log bias field from multiLevelBiasCorrection.
+    slabSize: int
+        Number of slices corrected at a time (see applyBias).
+
+    Returns
+    --------
+    dataWithoutBias: sitkImage
+        Data without bias (upsampleBias gives the removed bias at the resolution of inputImage).
+
+    """
+
+    return applyBias(inputImage, coarseBias, slabSize)
+
+def upsampleBias(bias, referenceImage, firstSlice=0, lastSlice=None):
+
+    """Interpolate a coarse log bias field on the grid of an image (or on some of its slices) with
+    cubic B-splines in physical coordinates.
+
+    Parameters
+    -----------
+    bias: sitkImage
+        Coarse log bias field (e.g. from createCoarseGrid).
+    referenceImage: sitkImage
+        Image with the output grid.
+    firstSlice: int
+        First slice (last axis of the sitkImage) of the output grid.
+    lastSlice: int
+        Slice after the last one of the output grid (None for the last slice of referenceImage).
+
+    Returns
+    --------
+    upsampledBias: sitkImage
+        Log bias field on the slices of the reference grid.
+
+    """
+
+    size = list(referenceImage.GetSize())
+    if lastSlice is None:
+        lastSlice = size[-1]
+    size[-1] = lastSlice - firstSlice
+
+    grid = sitk.Image(size, sitk.sitkFloat32)
+    grid.SetOrigin(referenceImage.TransformIndexToPhysicalPoint([0]*(len(size)-1) + [firstSlice]))
+    grid.SetSpacing(referenceImage.GetSpacing())
+    grid.SetDirection(referenceImage.GetDirection())
+
+    return sitk.Resample(bias, grid, sitk.Transform(), sitk.sitkBSpline, 0., sitk.sitkFloat32, True)
+
+def applyBias(inputImage, bias, slabSize=32, outputData=None):
+
+    """Divide an image by the exponential of a log bias field, a few slices at a time. Each slab
+    is cast, divided and cast back to int16 in a single float32 buffer, instead of creating full
+    resolution float images for the cast, the exponential and the division. A coarse bias
+    (with a grid different from the image one) is upsampled slab by slab.
+
+    Parameters
+    -----------
+    inputImage: sitkImage
+        Image to correct.
+    bias: sitkImage
+        Log bias field, on the grid of inputImage or on a coarse grid (see createCoarseGrid).
+    slabSize: int
+        Number of slices (last axis of the sitkImage) corrected at a time.
+    outputData: np.array
+        Optional int16 array with the (z, y, x) shape of inputImage where the corrected slabs are
+        written (e.g. a memory-mapped file), the returned image is then a copy of it.
+
+    Returns
+    --------
+    dataWithoutBias: sitkImage
+        Data without bias (int16).
+
+    """
+
+    inputData = sitk.GetArrayViewFromImage(inputImage)
+    coarse = (bias.GetSize() != inputImage.GetSize() or bias.GetOrigin() != inputImage.GetOrigin()
+              or bias.GetSpacing() != inputImage.GetSpacing())
+    if not coarse:
+        biasData = sitk.GetArrayViewFromImage(bias)
+    if outputData is None:
+        outputData = np.empty(inputData.shape, np.int16)
+
+    numberOfSlices = inputData.shape[0]
+    for firstSlice in range(0, numberOfSlices, slabSize):
+        lastSlice = min(firstSlice + slabSize, numberOfSlices)
+        if coarse:
+            # The image must outlive the view of its buffer
+            biasSlabImage = upsampleBias(bias, inputImage, firstSlice, lastSlice)
+            biasSlab = sitk.GetArrayViewFromImage(biasSlabImage)
+        else:
+            biasSlab = biasData[firstSlice:lastSlice]
+
+        slab = inputData[firstSlice:lastSlice].astype(np.float32)
+        slab /= np.exp(biasSlab, dtype=np.float32)
+        # Same truncation towards zero as sitk.Cast
+        np.copyto(outputData[firstSlice:lastSlice], slab, casting='unsafe')
+
+    dataWithoutBias = sitk.GetImageFromArray(outputData)
+    dataWithoutBias.CopyInformation(inputImage)
+
+    return dataWithoutBias
+
+def createForegroundMask(inputImage):
+
+    """Foreground mask from an Otsu threshold, so that the background without rock is not used to
+    fit the bias.
+
+    Parameters
+    -----------
+    inputImage: sitkImage
+        We expect an sitkImage from sitk.ReadImage.
+
+    Returns
+    --------
+    mask: sitkImage
+        Mask with 1 for the voxels above the Otsu threshold.
+
+    """
+
+    return sitk.OtsuThreshold(inputImage, 0, 1)
+
+@timedStage('writeImage')
 def writeImage(dataPath, data):
     
     """Wrapper of image writing operation from SimpleITK.
@@ -63,10 +318,13 @@ if __name__=='__main__':
     inputName = '/testSample/testSample.nii.gz'
     outputName = '/testSample/testSample_unbiased.nii.gz' #The forward slash is necessary to path+*Name work!
     biasName = '/testSample/testSample_biasField.nii.gz'
+    coarseBiasName = '/testSample/testSample_coarseBiasField.nii.gz'
     
     image = sitk.ReadImage(path+inputName)
     
-    dataWithoutBias, bias = shrinkBiasCorrection(image)
+    mask = createForegroundMask(image)
+    dataWithoutBias, bias, coarseBias = multiLevelBiasCorrection(image, maskImage=mask)
 
     writeImage(path+outputName, dataWithoutBias)
     writeImage(path+biasName, bias)
+    writeImage(path+coarseBiasName, coarseBias) # applyCoarseBias re-applies it to a repeat scan
@@ -10,12 +10,18 @@ import sys
 sys.path.append('../NLM') #ATENTION: This path depends on where you cloned our NLM repository
 
 import os
+import numpy as np
+import nibabel as nib
 import SimpleITK as sitk
 from modifiedNLM.estimate.noise_estimate import rician_estimate
-from modifiedNLM.filter.modified_nl_means import rician_denoise_nl_means
+from modifiedNLM.filter.modified_nl_means import (rician_denoise_nl_means,
+                                                  rician_denoise_nl_means_slabs)
+from modifiedNLM.filter.tiled_nl_means import denoise_tiled
+from runtimeConfig import getConfig, timedStage
 
 
-def NLM(imageData):
+def NLM(imageData, numThreads=None, dtype=None, numWorkers=None, tileShape=64, patchSize=5,
+        patchDistance=6, hMultiplier=1.15):
 
     """Wrapper of modified NLM imported from https://github.com/CIERMag-FFPaivaStudents/NLM.
 
@@ -23,6 +29,23 @@ def NLM(imageData):
     ----------
     imageData: array
         Numpy array from image desired to denoise. Atention: Be shure your image has Rician noise.
+    numThreads: int
+        Number of cores sharing the image planes (None for the 'denoising' threads of the runtime
+        configuration, all the cores if it is not set).
+    dtype: dtype
+        np.float32 halves the memory of the whole denoising (None keeps float32 images and
+        converts other types to float64).
+    numWorkers: int
+        If given, the image is split in overlapping tiles denoised by this number of processes
+        (see denoise_tiled), with the same result. Use it instead of numThreads to fill a node.
+    tileShape: int or tuple
+        Shape of the tiles used with numWorkers.
+    patchSize: int
+        Size of the patches.
+    patchDistance: int
+        Maximal distance in voxels where to search patches.
+    hMultiplier: float
+        Cut-off distance h of the filter in units of the estimated noise standard deviation.
 
     Returns
     -------
@@ -31,15 +54,148 @@ def NLM(imageData):
 
     """
 
-    ricianSigma = rician_estimate(imageData)
-    patch_kw = dict(patch_size=5,      # 5x5 patches
-                patch_distance=6,  # 13x13 search area
+    with getConfig().stage('noiseEstimate', threads=1):
+        ricianSigma = rician_estimate(imageData)
+    patch_kw = dict(patch_size=patchSize,      # default 5x5 patches
+                patch_distance=patchDistance,  # default 13x13 search area
                 multichannel=False,
                 preserve_range=True)
-    denoisedData = rician_denoise_nl_means(imageData, h=1.15 * ricianSigma, fast_mode=False,
-                           **patch_kw)
+    if numWorkers is not None:
+        del patch_kw['multichannel']
+        with getConfig().stage('denoising', threads=numWorkers, workers=numWorkers):
+            denoisedData = denoise_tiled(imageData, tileShape, workers=numWorkers,
+                                         h=hMultiplier * ricianSigma, fast_mode=False, dtype=dtype,
+                                         **patch_kw)
+    else:
+        numThreads = denoisingThreads(numThreads)
+        with getConfig().stage('denoising', threads=numThreads):
+            denoisedData = rician_denoise_nl_means(imageData, h=hMultiplier * ricianSigma,
+                                   fast_mode=False, num_threads=numThreads, dtype=dtype, **patch_kw)
     return denoisedData
 
+def NLMStreaming(inputPath, outputPath, ricianSigma=None, slabSize=32, numThreads=None,
+                 dtype=None):
+
+    """Out-of-core version of NLM, the image is denoised slab by slab along z and written to a
+    memory-mapped NIfTI file. The result is the same as NLM with the same ricianSigma.
+
+    Parameters
+    ----------
+    inputPath: string
+        Path to the NIfTI image desired to denoise (.nii or .nii.gz).
+    outputPath: string
+        Path to the denoised image. It must be an uncompressed .nii file to be memory-mapped.
+    ricianSigma: float
+        Standard deviation of the Rician noise. If None, it is estimated reading the image slab by slab.
+    slabSize: int
+        Number of z slices denoised at each step.
+    numThreads: int
+        Number of cores sharing the image planes (see NLM).
+    dtype: dtype
+        Floating point type of the denoising and of the output file (see NLM).
+
+    """
+
+    inputImage = nib.load(inputPath)
+    imageData = NiftiSlabReader(inputImage)
+
+    if ricianSigma is None:
+        with getConfig().stage('noiseEstimate', threads=1):
+            ricianSigma = rician_estimate(imageData)
+
+    patch_kw = dict(patch_size=5,      # 5x5 patches
+                patch_distance=6,  # 13x13 search area
+                preserve_range=True)
+
+    if dtype is None:
+        dtype = np.float32 if imageData.dtype == np.float32 else np.float64
+
+    outputData = createNiftiMemmap(outputPath, inputImage, imageData.shape, dtype)
+    numThreads = denoisingThreads(numThreads)
+    with getConfig().stage('denoising', threads=numThreads):
+        rician_denoise_nl_means_slabs(imageData, outputData, slab_size=slabSize,
+                                      h=1.15 * ricianSigma, fast_mode=False,
+                                      num_threads=numThreads, dtype=dtype, **patch_kw)
+        outputData.flush()
+
+def denoisingThreads(numThreads=None):
+
+    """Number of threads of the denoising kernel: numThreads if given, else the 'denoising' threads
+    of the runtime configuration, else all the cores."""
+
+    if numThreads is None:
+        numThreads = getConfig().getThreads('denoising')
+
+    return numThreads or os.cpu_count()
+
+class NiftiSlabReader:
+
+    """Lazy view of a nibabel image with the (z, y, x) axes order of sitk.GetArrayFromImage, only
+    the sliced z slabs are read from disk.
+
+    Parameters
+    ----------
+    image: nibabelImage
+        Image from nib.load.
+
+    """
+
+    def __init__(self, image):
+        self.dataobj = image.dataobj
+        self.shape = tuple(reversed(image.shape))
+        self.dtype = image.get_data_dtype()
+
+    def __getitem__(self, zSlice):
+        return np.asarray(self.dataobj[..., zSlice]).T
+
+def createNiftiMemmap(dataPath, baseImage, shape, dtype):
+
+    """Create an uncompressed NIfTI file with the spatial information of a base image and
+    memory-map its voxels.
+
+    Parameters
+    ----------
+    dataPath: string
+        String containing a path to the directory + the data name (.nii).
+    baseImage: nibabelImage
+        Image with the information that you want to copy.
+    shape: tuple
+        Shape in (z, y, x) order.
+    dtype: dtype
+        Voxel data type.
+
+    Returns
+    -------
+    data: memmap
+        Writable (z, y, x) view of the file voxels.
+
+    """
+
+    if not dataPath.endswith('.nii'):
+        raise ValueError('Memory-mapped output must be an uncompressed .nii file.')
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(tuple(reversed(shape)))
+    header.set_data_dtype(dtype)
+    header.set_zooms(baseImage.header.get_zooms()[:3])
+    header.set_qform(*baseImage.header.get_qform(coded=True))
+    header.set_sform(*baseImage.header.get_sform(coded=True))
+    header.set_xyzt_units(*baseImage.header.get_xyzt_units())
+    header.set_data_offset(header.single_vox_offset)
+    offset = header.get_data_offset()
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    with open(dataPath, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.seek(offset + size - 1)
+        f.write(b'\x00')
+
+    data = np.memmap(dataPath, dtype=header.get_data_dtype(), mode='r+', offset=offset,
+                     shape=tuple(reversed(shape)), order='F')
+
+    return data.T
+
 def createSITKcopy(image, array):
 
     """Create new sitk image from array with same information from base image.
@@ -63,6 +219,7 @@ def createSITKcopy(image, array):
 
     return copy
 
+@timedStage('writeImage')
 def writeImage(dataPath, data):
 
     """Wrapper of image writing operation from SimpleITK.
@@ -0,0 +1,387 @@
+# Author: Gustavo Solcia
+# E-mail: gustavo.solcia@usp.br
+
+"""Content-addressed disk cache of the pipeline stages: bias field correction, denoising, marching
+cubes and surface smoothing. A stage result is keyed by the hash of its input file (or by the key
+of the previous stage) and by its parameters, so re-running a sweep over the smoothing parameters
+reuses the bias correction, the denoising and the marching cubes already computed. The least
+recently used results are removed when the cache is larger than its maximum size.
+
+"""
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import hashlib
+import importlib
+import vtk
+import SimpleITK as sitk
+from biasField import shrinkBiasCorrection
+from denoising import NLM, createSITKcopy
+
+recon = importlib.import_module('3dRecon')
+
+# Part of every key: increase it when a stage changes its results or its file format, so that the
+# results of the previous code are not reused
+CACHE_VERSION = 2
+
+class PipelineCache:
+
+    """Directory of stage results named by their key, with size-based LRU eviction.
+
+    Parameters
+    ----------
+    cacheDir: string
+        Directory where the results are stored.
+    maxSize: float
+        Maximum size of the cache in bytes.
+
+    """
+
+    def __init__(self, cacheDir, maxSize=20*1024**3):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxSize = maxSize
+        self._fileHashes = {}
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+    def fileHash(self, path):
+
+        """SHA-256 of a file content, remembered while the file size and modification time do not
+        change.
+
+        Parameters
+        ----------
+        path: string
+            Path to the file.
+
+        Returns
+        -------
+        digest: string
+            Hexadecimal digest of the file.
+
+        """
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        fileId = (path, stat.st_size, stat.st_mtime_ns)
+        if fileId not in self._fileHashes:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha.update(block)
+            self._fileHashes[fileId] = sha.hexdigest()
+
+        return self._fileHashes[fileId]
+
+    def stageKey(self, stage, inputKey, **parameters):
+
+        """Key of a stage result from the key of its input and its parameters.
+
+        Parameters
+        ----------
+        stage: string
+            Stage name.
+        inputKey: string
+            Hash of the input file or key of the previous stage.
+        parameters: dict
+            Parameters of the stage (JSON serializable).
+
+        Returns
+        -------
+        key: string
+            Hexadecimal digest.
+
+        """
+
+        description = json.dumps([CACHE_VERSION, stage, inputKey, parameters], sort_keys=True)
+
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def paths(self, key, suffixes):
+
+        """Paths of the files of a stage result."""
+
+        return [os.path.join(self.cacheDir, key+suffix) for suffix in suffixes]
+
+    def load(self, key, suffixes):
+
+        """Look for a stage result and mark it as recently used.
+
+        Parameters
+        ----------
+        key: string
+            Key of the stage result.
+        suffixes: list
+            Suffixes (with extension) of the files of the result.
+
+        Returns
+        -------
+        paths: list
+            Paths of the files, or None if any of them is missing.
+
+        """
+
+        paths = self.paths(key, suffixes)
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        for path in paths:
+            os.utime(path)
+
+        return paths
+
+    def store(self, key, suffixes, writeFunctions):
+
+        """Store a stage result and evict the least recently used results if needed.
+
+        Parameters
+        ----------
+        key: string
+            Key of the stage result.
+        suffixes: list
+            Suffixes (with extension) of the files of the result.
+        writeFunctions: list
+            Function writing each file, called with a temporary path with the same extension.
+
+        Returns
+        -------
+        paths: list
+            Paths of the stored files.
+
+        """
+
+        paths = self.paths(key, suffixes)
+        for path, suffix, writeFunction in zip(paths, suffixes, writeFunctions):
+            extension = suffix[suffix.index('.'):] if '.' in suffix else ''
+            temporaryPath = path[:len(path)-len(extension)]+'.tmp%d' % os.getpid()+extension
+            writeFunction(temporaryPath)
+            os.replace(temporaryPath, path)
+        self.evict(keep=paths)
+
+        return paths
+
+    def evict(self, keep=()):
+
+        """Remove the least recently used files until the cache fits in maxSize.
+
+        Parameters
+        ----------
+        keep: list
+            Paths that must not be removed.
+
+        """
+
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.is_file() and '.tmp' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            totalSize -= size
+
+def cachedBiasCorrection(cache, inputPath, shrinkFactor=4):
+
+    """Cached shrinkBiasCorrection of an image file.
+
+    Parameters
+    ----------
+    cache: PipelineCache
+        Cache of the stage results.
+    inputPath: string
+        Path to the image.
+    shrinkFactor: int
+        Integer factor of the image shrinking.
+
+    Returns
+    -------
+    dataWithoutBias: sitkImage
+        Image without bias.
+    bias: sitkImage
+        The removed bias field.
+    key: string
+        Key of the result, used as input key of cachedNLM.
+
+    """
+
+    key = cache.stageKey('bias', cache.fileHash(inputPath), shrinkFactor=shrinkFactor)
+    suffixes = ['_unbiased.nii', '_biasField.nii']
+    paths = cache.load(key, suffixes)
+    if paths is not None:
+        return sitk.ReadImage(paths[0]), sitk.ReadImage(paths[1]), key
+
+    dataWithoutBias, bias = shrinkBiasCorrection(sitk.ReadImage(inputPath), shrinkFactor)
+    cache.store(key, suffixes, [lambda path: sitk.WriteImage(dataWithoutBias, path),
+                                lambda path: sitk.WriteImage(bias, path)])
+
+    return dataWithoutBias, bias, key
+
+def cachedNLM(cache, image, inputKey, patchSize=5, patchDistance=6, hMultiplier=1.15, **kwargs):
+
+    """Cached NLM denoising of the result of a previous stage.
+
+    Parameters
+    ----------
+    cache: PipelineCache
+        Cache of the stage results.
+    image: sitkImage
+        Image desired to denoise.
+    inputKey: string
+        Key of the stage that produced image (or cache.fileHash of its file).
+    patchSize, patchDistance, hMultiplier:
+        Parameters of NLM.
+    kwargs: dict
+        Other arguments of NLM, that do not change the result (numThreads, numWorkers...).
+
+    Returns
+    -------
+    denoised: sitkImage
+        Denoised image.
+    key: string
+        Key of the result.
+
+    """
+
+    dtype = kwargs.get('dtype')
+    key = cache.stageKey('nlm', inputKey, patchSize=patchSize, patchDistance=patchDistance,
+                         hMultiplier=hMultiplier, dtype=None if dtype is None else str(dtype))
+    suffixes = ['_denoised.nii']
+    paths = cache.load(key, suffixes)
+    if paths is not None:
+        return sitk.ReadImage(paths[0]), key
+
+    denoisedData = NLM(sitk.GetArrayViewFromImage(image), patchSize=patchSize,
+                       patchDistance=patchDistance, hMultiplier=hMultiplier, **kwargs)
+    denoised = createSITKcopy(image, denoisedData)
+    cache.store(key, suffixes, [lambda path: sitk.WriteImage(denoised, path)])
+
+    return denoised, key
+
+def cachedMarchingCubes(cache, segmentationPath, threshold, transformCoord=True,
+                        engine='marchingCubes', cropComponent=True):
+
+    """Cached applyMarchingCubes of a segmentation file.
+
+    Parameters
+    ----------
+    cache: PipelineCache
+        Cache of the stage results.
+    segmentationPath: string
+        Path to the segmentation image.
+    threshold: float
+        threshold for binarization purposes
+    transformCoord: bool
+        Whether to apply the QForm transform.
+    engine, cropComponent:
+        Parameters of applyMarchingCubes.
+
+    Returns
+    -------
+    largestRegion: vtkPolyData
+        Largest connected region of the marching cubes surface.
+    key: string
+        Key of the result, used as input key of cachedPolyFilter.
+
+    """
+
+    key = cache.stageKey('cubes', cache.fileHash(segmentationPath), threshold=threshold,
+                         transformCoord=transformCoord, engine=engine, cropComponent=cropComponent)
+    suffixes = ['_cubes.vtp']
+    paths = cache.load(key, suffixes)
+    if paths is not None:
+        return readPolyData(paths[0]), key
+
+    path, name = os.path.split(os.path.abspath(segmentationPath))
+    vtkImage, QFormMatrix = recon.readImage(path, '/'+name)
+    largestRegion = recon.applyMarchingCubes(vtkImage, threshold, transformCoord, QFormMatrix,
+                                             engine=engine, cropComponent=cropComponent)
+    cache.store(key, suffixes, [lambda path: writePolyData(path, largestRegion)])
+
+    return largestRegion, key
+
+def cachedPolyFilter(cache, poly, inputKey, numberOfIterations=100, passBand=0.25,
+                     featureAngle=120.0, checkInterval=None, tolerance=5e-3, maxShrinkage=None,
+                     numberOfWorkers=1):
+
+    """Cached applyPolyFilter of the result of a previous stage.
+
+    Parameters
+    ----------
+    cache: PipelineCache
+        Cache of the stage results.
+    poly: vtkPolyData
+        Surface desired to smooth.
+    inputKey: string
+        Key of the stage that produced poly.
+    numberOfIterations, passBand, featureAngle, checkInterval, tolerance, maxShrinkage:
+        Parameters of applyPolyFilter.
+    numberOfWorkers: int
+        Parameter of applyPolyFilter, in the key since the regions are appended in another order.
+
+    Returns
+    -------
+    smoothPoly: vtkPolyData
+        Smooth surface.
+    key: string
+        Key of the result.
+
+    """
+
+    key = cache.stageKey('smooth', inputKey, numberOfIterations=numberOfIterations,
+                         passBand=passBand, featureAngle=featureAngle, checkInterval=checkInterval,
+                         tolerance=tolerance, maxShrinkage=maxShrinkage,
+                         numberOfWorkers=numberOfWorkers)
+    suffixes = ['_smooth.vtp']
+    paths = cache.load(key, suffixes)
+    if paths is not None:
+        return readPolyData(paths[0]), key
+
+    smoothPoly = recon.applyPolyFilter(poly, numberOfIterations, passBand, featureAngle,
+                                       checkInterval, tolerance, maxShrinkage, numberOfWorkers)
+    cache.store(key, suffixes, [lambda path: writePolyData(path, smoothPoly)])
+
+    return smoothPoly, key
+
+def readPolyData(dataPath):
+
+    """Wrapper of vtkXMLPolyDataReader."""
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(dataPath)
+    reader.Update()
+
+    return reader.GetOutput()
+
+def writePolyData(dataPath, poly):
+
+    """Wrapper of vtkXMLPolyDataWriter with binary data."""
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(poly)
+    writer.SetFileName(dataPath)
+    writer.SetDataModeToBinary()
+    writer.Write()
+
+if __name__=='__main__':
+
+    path = os.path.abspath('/wormholeCFD/ImageProcessing')
+    cache = PipelineCache(path+'/.pipelineCache', maxSize=20*1024**3)
+
+    dataWithoutBias, bias, biasKey = cachedBiasCorrection(cache, path+'/testSample/testSample.nii.gz')
+    denoised, nlmKey = cachedNLM(cache, dataWithoutBias, biasKey)
+    sitk.WriteImage(denoised, path+'/testSample/testSample_denoised.nii.gz')
+
+    # After the Atropos segmentation (see README_Atropos), a sweep over the smoothing parameters
+    # computes the marching cubes only once.
+    mcPoly, cubesKey = cachedMarchingCubes(cache, path+'/testSample/testSample_segmentation.nii.gz', 1.5)
+    for passBand in [0.25, 0.3, 0.4]:
+        smoothPoly, _ = cachedPolyFilter(cache, mcPoly, cubesKey, passBand=passBand)
+        recon.writeSTL(path, '/testSample/smooth_testSample_%g.stl' % passBand, smoothPoly)
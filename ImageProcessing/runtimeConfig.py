@@ -0,0 +1,202 @@
+# Author: Gustavo Solcia
+# E-mail: gustavo.solcia@usp.br
+
+"""Runtime configuration shared by the pipeline stages: number of threads of each stage, and
+wall time, CPU time and peak memory of each stage run, written to a JSON run log.
+
+"""
+
+import os
+import json
+import time
+import socket
+import functools
+from contextlib import contextmanager
+import SimpleITK as sitk
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class RuntimeConfig:
+
+    """Threads of the pipeline stages and record of their runs.
+
+    Parameters
+    ----------
+    threads: int
+        Default number of threads of every stage (None keeps the SimpleITK default, all the cores).
+    stageThreads: dict
+        Number of threads of some stages by name (e.g. {'denoising': 4}), overriding threads.
+
+    """
+
+    def __init__(self, threads=None, stageThreads=None):
+        self.threads = threads
+        self.stageThreads = dict(stageThreads or {})
+        self.records = []
+
+    def getThreads(self, stageName):
+
+        """Number of threads of a stage (None for the SimpleITK default)."""
+
+        return self.stageThreads.get(stageName, self.threads)
+
+    @contextmanager
+    def stage(self, stageName, threads=None, **info):
+
+        """Context of a stage run. The SimpleITK filters created inside it use the stage number of
+        threads, and a record of the run is added when it ends.
+
+        Parameters
+        ----------
+        stageName: string
+            Name of the stage.
+        threads: int
+            Number of threads used by the stage, if it is not the configured one (e.g. an explicit
+            argument of the stage function).
+        info: dict
+            Additional information saved in the record (JSON serializable).
+
+        Yields
+        ------
+        threads: int
+            Number of threads that the stage should use (None for the SimpleITK default).
+
+        """
+
+        if threads is None:
+            threads = self.getThreads(stageName)
+        previousThreads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+        if threads is not None:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+        record = {'stage': stageName,
+                  'threads': threads or previousThreads}
+        record.update(info)
+        startWall, startCPU = time.perf_counter(), time.process_time()
+        try:
+            yield threads
+        finally:
+            record['wallTime'] = time.perf_counter() - startWall
+            record['cpuTime'] = time.process_time() - startCPU
+            record['peakRSS'] = peakRSS()
+            self.records.append(record)
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(previousThreads)
+
+    def summary(self, records=None):
+
+        """Total wall and CPU time of each stage name, and the overall peak memory.
+
+        Parameters
+        ----------
+        records: list
+            Records to summarize instead of the ones of this configuration.
+
+        Returns
+        -------
+        summary: dict
+            {'stages': {stageName: {'runs', 'wallTime', 'cpuTime'}}, 'peakRSS': bytes or None}
+
+        """
+
+        records = self.records if records is None else records
+        stages = {}
+        for record in records:
+            total = stages.setdefault(record['stage'], {'runs': 0, 'wallTime': 0., 'cpuTime': 0.})
+            total['runs'] += 1
+            total['wallTime'] += record['wallTime']
+            total['cpuTime'] += record['cpuTime']
+
+        peaks = [record['peakRSS'] for record in records] + [peakRSS()]
+        peaks = [peak for peak in peaks if peak is not None]
+        peak = max(peaks) if peaks else None
+
+        return {'stages': stages, 'peakRSS': peak}
+
+    def writeLog(self, logPath, records=None, **metadata):
+
+        """Write the records and their summary to a JSON run log.
+
+        Parameters
+        ----------
+        logPath: string
+            Path to the JSON file.
+        records: list
+            Records to write instead of the ones of this configuration (e.g. gathered from worker
+            processes).
+        metadata: dict
+            Additional information saved in the log (JSON serializable).
+
+        """
+
+        records = self.records if records is None else records
+        log = {'host': socket.gethostname(),
+               'cpuCount': os.cpu_count(),
+               'threads': self.threads,
+               'stageThreads': self.stageThreads,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'records': records,
+               'summary': self.summary(records)}
+        log.update(metadata)
+
+        with open(logPath, 'w') as f:
+            json.dump(log, f, indent=2)
+
+def peakRSS():
+
+    """Peak resident memory of the process (and of its finished child processes) in bytes, None
+    where the resource module is not available (Windows)."""
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if os.uname().sysname == 'Darwin' else 1024
+    selfRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childrenRSS = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return max(selfRSS, childrenRSS) * unit
+
+_config = RuntimeConfig()
+
+def timedStage(stageName):
+
+    """Decorator running a function as a stage of the runtime configuration of the process.
+
+    Parameters
+    ----------
+    stageName: string
+        Name of the stage.
+
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with getConfig().stage(stageName):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def getConfig():
+
+    """Runtime configuration of the process."""
+
+    return _config
+
+def setConfig(config):
+
+    """Replace the runtime configuration of the process.
+
+    Parameters
+    ----------
+    config: RuntimeConfig
+        New configuration.
+
+    """
+
+    global _config
+    _config = config
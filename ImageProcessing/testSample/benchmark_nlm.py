@@ -0,0 +1,95 @@
+#Author: Gustavo Solcia
+#Email: gustavo.solcia@usp.br
+
+"""Micro-benchmark of the classic 3D NLM kernel on the test cylinder of create_testSample_image.py.
+
+Usage: python benchmark_nlm.py [--shape 63 63 128] [--repeat 3] [--threads 1]
+
+Run it before and after a change of the Cython kernels (rebuilding NLM in between) to compare the
+denoised voxels per second.
+"""
+
+import sys
+
+sys.path.append('../../NLM') #ATENTION: This path depends on where you cloned our NLM repository
+
+import time
+import argparse
+import numpy as np
+from create_testSample_image import fill_image, add_cosine_field, add_rician_noise
+from modifiedNLM.estimate.noise_estimate import rician_estimate
+from modifiedNLM.filter.modified_nl_means import rician_denoise_nl_means
+
+def create_cylinder(shape, seed=0):
+    """Creates the noisy test cylinder with the given shape.
+
+    Parameters
+    ----------
+    shape : tuple
+        The (x, y, z) image size.
+    seed : int
+        Seed of the Rician noise.
+
+    Returns
+    -------
+    image : np.array
+        The noised image.
+    """
+
+    np.random.seed(seed)
+    image = np.zeros(shape)
+    image = fill_image(image, shape[0]/2, shape[1]/2)
+    image = add_cosine_field(image, plot_field=False)
+    image = add_rician_noise(image, 1, plot_noise=False)
+
+    return image
+
+def benchmark(image, repeat, num_threads, dtype):
+    """Times the classic NLM with the parameters of ImageProcessing/denoising.py.
+
+    Parameters
+    ----------
+    image : np.array
+        The image to be denoised.
+    repeat : int
+        Number of timed runs, the best one is kept.
+    num_threads : int
+        Number of OpenMP threads.
+    dtype : dtype
+        Floating point type of the denoising.
+
+    Returns
+    -------
+    voxels_per_second : float
+        Denoised voxels per second of the best run.
+    denoised : np.array
+        The denoised image.
+    """
+
+    sigma = rician_estimate(image)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        denoised = rician_denoise_nl_means(image, patch_size=5, patch_distance=6,
+                                           h=1.15*sigma, fast_mode=False,
+                                           preserve_range=True, num_threads=num_threads,
+                                           dtype=dtype)
+        best = min(best, time.perf_counter() - start)
+
+    return image.size/best, denoised
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[63, 63, 128])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--save', default=None, help='save the denoised image (.npy) to compare runs')
+    args = parser.parse_args()
+
+    image = create_cylinder(tuple(args.shape))
+    for dtype in (np.float64, np.float32):
+        voxels_per_second, denoised = benchmark(image, args.repeat, args.threads, dtype)
+        print('%s: %.3g voxels/s' % (np.dtype(dtype).name, voxels_per_second))
+        if args.save is not None and dtype is np.float64:
+            np.save(args.save, denoised)
@@ -0,0 +1,90 @@
+#Author: Gustavo Solcia
+#Email: gustavo.solcia@usp.br
+
+"""Timing comparison of the isosurface engines of applyMarchingCubes on the test cylinder of
+create_testSample_image.py.
+
+Usage: python benchmark_surface.py [--shape 256 256 256] [--repeat 3] [--threads 4]
+
+The labels of the cylinder are thresholded as after the Atropos segmentation: 2 inside the
+cylinder and 1 elsewhere.
+"""
+
+import sys
+
+sys.path.append('..')
+
+import time
+import argparse
+import importlib
+import numpy as np
+import vtk
+from create_testSample_image import fill_image
+
+recon = importlib.import_module('3dRecon')
+
+def create_segmentation(shape):
+    """Creates a two-label segmentation of the test cylinder.
+
+    Parameters
+    ----------
+    shape : tuple
+        The (x, y, z) image size.
+
+    Returns
+    -------
+    segmentation : np.array
+        uint8 labels in (z, y, x) order, 2 inside the cylinder.
+    """
+
+    image = fill_image(np.zeros(shape), shape[0]/2, shape[1]/2)
+    segmentation = np.where(image == 5, 2, 1).astype(np.uint8)
+
+    return np.ascontiguousarray(segmentation.transpose(2, 1, 0))
+
+def benchmark(segmentation, engine, repeat):
+    """Times applyMarchingCubes (without the transform) with an engine.
+
+    Parameters
+    ----------
+    segmentation : np.array
+        Label image.
+    engine : string
+        Engine of applyMarchingCubes.
+    repeat : int
+        Number of timed runs, the best one is kept.
+
+    Returns
+    -------
+    best : float
+        Wall time of the best run in seconds.
+    poly : vtkPolyData
+        Largest connected region of the surface.
+    """
+
+    threshold = 2 if engine == 'discreteFlyingEdges' else 1.5
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        poly = recon.applyMarchingCubes(segmentation, threshold, False, None, engine=engine)
+        best = min(best, time.perf_counter() - start)
+
+    return best, poly
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 128])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='VTK SMP threads (default: all cores)')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        vtk.vtkSMPTools.Initialize(args.threads)
+    segmentation = create_segmentation(tuple(args.shape))
+    print('VTK %s, SMP backend %s, %d threads' % (vtk.vtkVersion.GetVTKVersion(),
+          vtk.vtkSMPTools.GetBackend(), vtk.vtkSMPTools.GetEstimatedNumberOfThreads()))
+    for engine in recon.ENGINES:
+        best, poly = benchmark(segmentation, engine, args.repeat)
+        print('%s: %.3f s, %d points, %d triangles' % (engine, best, poly.GetNumberOfPoints(),
+                                                      poly.GetNumberOfCells()))
@@ -0,0 +1,300 @@
+# Author: Gustavo Solcia
+# E-mail: gustavo.solcia@usp.br
+
+"""Batch processing of many samples: bias field correction and denoising until the
+segmentation-ready image, with a pool of worker processes limited by the available memory.
+
+Usage: python wormholeBatch.py manifest.txt --workers 4 --threads 4 --memory 32 --log run.json
+
+Each line of the manifest holds the path to a sample image and, optionally, the output directory
+(default: the directory of the image). Empty lines and lines starting with # are ignored. For a
+sample.nii.gz image we write sample_unbiased.nii.gz, sample_biasField.nii.gz and
+sample_denoised.nii.gz, ready for the Atropos segmentation (see README_Atropos).
+
+"""
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../NLM')) #ATENTION: This path depends on where you cloned our NLM repository
+
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from biasField import shrinkBiasCorrection
+from denoising import NLM, createSITKcopy, writeImage
+from runtimeConfig import RuntimeConfig, getConfig, setConfig
+
+def readManifest(manifestPath):
+
+    """Read the list of samples of a manifest file.
+
+    Parameters
+    ----------
+    manifestPath: string
+        Path to the manifest file.
+
+    Returns
+    -------
+    samples: list
+        List of (sampleName, inputPath, outputDir) tuples.
+
+    Raises
+    ------
+    ValueError
+        If two samples would write the same output files (same name and output directory).
+
+    """
+
+    baseDir = os.path.dirname(os.path.abspath(manifestPath))
+    samples = []
+    with open(manifestPath) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            inputPath = os.path.join(baseDir, fields[0])
+            outputDir = os.path.join(baseDir, fields[1]) if len(fields) > 1 else os.path.dirname(inputPath)
+            outputDir = os.path.normpath(outputDir)
+            sampleName = os.path.basename(inputPath)
+            for extension in ('.gz', '.nii'):
+                if sampleName.endswith(extension):
+                    sampleName = sampleName[:-len(extension)]
+            for otherName, otherPath, otherDir in samples:
+                if (otherName, otherDir) == (sampleName, outputDir):
+                    raise ValueError('%s and %s would both write %s in %s.' %
+                                     (otherPath, inputPath, sampleName, outputDir))
+            samples.append((sampleName, inputPath, outputDir))
+
+    return samples
+
+def estimateMemory(inputPath, bytesPerVoxel):
+
+    """Estimate the peak memory of one sample from the image size in its header.
+
+    Parameters
+    ----------
+    inputPath: string
+        Path to the sample image.
+    bytesPerVoxel: float
+        Peak memory per voxel of the whole processing.
+
+    Returns
+    -------
+    memory: float
+        Estimated peak memory in bytes.
+
+    """
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(inputPath)
+    reader.ReadImageInformation()
+
+    return float(np.prod(reader.GetSize())) * bytesPerVoxel
+
+def availableMemory():
+
+    """Available memory in bytes from /proc/meminfo (None if unknown)."""
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return float(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def processSample(sampleName, inputPath, outputDir, numThreads=None, dtype=None, coarseBias=False):
+
+    """Bias field correction and denoising of one sample.
+
+    Parameters
+    ----------
+    sampleName: string
+        Name used as prefix of the output files.
+    inputPath: string
+        Path to the sample image.
+    outputDir: string
+        Directory of the output files.
+    numThreads: int
+        Number of cores used by the denoising (None for the runtime configuration, see NLM).
+    dtype: dtype
+        Floating point type of the denoising (see NLM).
+    coarseBias: bool
+        Save the bias field at the shrinked resolution (see shrinkBiasCorrection).
+
+    Returns
+    -------
+    report: dict
+        Voxel number, wall time of each step in seconds and the records of the stages (see
+        runtimeConfig).
+
+    """
+
+    os.makedirs(outputDir, exist_ok=True)
+    outputPrefix = os.path.join(outputDir, sampleName)
+    firstRecord = len(getConfig().records)
+    startTime = time.perf_counter()
+
+    with getConfig().stage('readImage'):
+        image = sitk.ReadImage(inputPath)
+    dataWithoutBias, bias = shrinkBiasCorrection(image, coarseBias=coarseBias)
+    del image
+    writeImage(outputPrefix+'_unbiased.nii.gz', dataWithoutBias)
+    writeImage(outputPrefix+'_biasField.nii.gz', bias)
+    biasTime = time.perf_counter()
+
+    imageData = sitk.GetArrayViewFromImage(dataWithoutBias)
+    denoisedData = NLM(imageData, numThreads=numThreads, dtype=dtype)
+    writeImage(outputPrefix+'_denoised.nii.gz', createSITKcopy(dataWithoutBias, denoisedData))
+    endTime = time.perf_counter()
+
+    records = getConfig().records[firstRecord:]
+    for record in records:
+        record['sample'] = sampleName
+        record['inputPath'] = inputPath
+
+    return {'voxels': int(imageData.size),
+            'biasTime': biasTime - startTime,
+            'denoisingTime': endTime - biasTime,
+            'totalTime': endTime - startTime,
+            'peakRSS': getConfig().summary(records)['peakRSS'],
+            'records': records}
+
+def initWorker(threads):
+
+    """Runtime configuration of a worker process: every stage uses the same number of threads."""
+
+    setConfig(RuntimeConfig(threads=threads))
+
+def runBatch(samples, workers=1, memoryBudget=None, bytesPerVoxel=48., numThreads=1, dtype=None,
+             coarseBias=False):
+
+    """Process samples in a pool of worker processes. A sample is started only if its estimated
+    memory fits in the budget with the samples already running, a sample larger than the budget
+    runs alone. The workers are reused, so the Python, SimpleITK and NLM startup is paid once per
+    worker instead of once per sample.
+
+    Parameters
+    ----------
+    samples: list
+        List of (sampleName, inputPath, outputDir) tuples from readManifest.
+    workers: int
+        Maximum number of samples processed at the same time.
+    memoryBudget: float
+        Memory in bytes shared by the running samples (None for the available memory).
+    bytesPerVoxel: float
+        Peak memory per voxel of one sample, used to estimate its memory.
+    numThreads: int
+        Number of cores used by every stage (SimpleITK filters and denoising) of each sample.
+    dtype: dtype
+        Floating point type of the denoising (see NLM).
+    coarseBias: bool
+        Save the bias fields at the shrinked resolution (see shrinkBiasCorrection).
+
+    Returns
+    -------
+    reports: dict
+        Report of processSample for each sample index in samples, or the raised exception (the
+        sample names of different directories may be the same).
+
+    """
+
+    if memoryBudget is None:
+        memoryBudget = availableMemory() or float('inf')
+
+    pending = []
+    running = {}
+    reports = {}
+    for index, sample in enumerate(samples):
+        try:
+            pending.append((index, estimateMemory(sample[1], bytesPerVoxel)))
+        except RuntimeError as error:
+            reports[index] = error
+            print('%s: failed (%s)' % (sample[0], str(error).strip().split('\n')[-1]), flush=True)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                             initargs=(numThreads,)) as executor:
+        while pending or running:
+            usedMemory = sum(memory for _, memory in running.values())
+            for index, memory in list(pending):
+                if len(running) >= workers:
+                    break
+                if running and usedMemory + memory > memoryBudget:
+                    continue
+                future = executor.submit(processSample, *samples[index], numThreads=numThreads,
+                                         dtype=dtype, coarseBias=coarseBias)
+                running[future] = (index, memory)
+                usedMemory += memory
+                pending.remove((index, memory))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, _ = running.pop(future)
+                sampleName = samples[index][0]
+                try:
+                    reports[index] = future.result()
+                    printReport(sampleName, reports[index])
+                except Exception as error:
+                    reports[index] = error
+                    print('%s: failed (%s)' % (sampleName, error), flush=True)
+
+    return reports
+
+def printReport(sampleName, report):
+
+    """Print the time and throughput of one sample."""
+
+    print('%s: bias %.1f s, denoising %.1f s, total %.1f s, %.3g Mvoxel/s' %
+          (sampleName, report['biasTime'], report['denoisingTime'], report['totalTime'],
+           report['voxels'] / report['totalTime'] / 1e6), flush=True)
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(prog='wormhole-batch', description=__doc__.split('\n\n')[0])
+    parser.add_argument('manifest', help='file with one sample image path (and output directory) per line')
+    parser.add_argument('--workers', type=int, default=1, help='samples processed at the same time')
+    parser.add_argument('--threads', type=int, default=1, help='threads of each sample')
+    parser.add_argument('--memory', type=float, default=None,
+                        help='memory budget in GB (default: available memory)')
+    parser.add_argument('--bytes-per-voxel', type=float, default=48.,
+                        help='estimated peak memory per voxel of one sample')
+    parser.add_argument('--float32', action='store_true', help='denoise in single precision')
+    parser.add_argument('--coarse-bias', action='store_true',
+                        help='save the bias fields at the shrinked resolution')
+    parser.add_argument('--log', default=None, help='JSON run log with the records of every stage')
+    args = parser.parse_args()
+
+    try:
+        samples = readManifest(args.manifest)
+    except ValueError as error:
+        parser.error(str(error))
+    memoryBudget = None if args.memory is None else args.memory * 1024**3
+    dtype = np.float32 if args.float32 else None
+
+    startTime = time.perf_counter()
+    reports = runBatch(samples, args.workers, memoryBudget, args.bytes_per_voxel, args.threads, dtype,
+                       args.coarse_bias)
+    totalTime = time.perf_counter() - startTime
+
+    succeeded = [report for report in reports.values() if isinstance(report, dict)]
+    totalVoxels = sum(report['voxels'] for report in succeeded)
+    print('%d/%d samples in %.1f s: %.2f samples/h, %.3g Mvoxel/s' %
+          (len(succeeded), len(samples), totalTime, 3600 * len(succeeded) / totalTime,
+           totalVoxels / totalTime / 1e6))
+
+    if args.log is not None:
+        records = [record for report in succeeded for record in report['records']]
+        RuntimeConfig(threads=args.threads).writeLog(args.log, records=records,
+                                                     workers=args.workers,
+                                                     samples=len(samples),
+                                                     succeeded=len(succeeded),
+                                                     totalTime=totalTime)
+
+    if len(succeeded) < len(samples):
+        sys.exit(1)
@@ -0,0 +1,226 @@
+# Author: Gustavo Solcia
+# E-mail: gustavo.solcia@usp.br
+
+"""In-memory pipeline from the micro-CT image to the smooth surface: bias field correction,
+denoising, Atropos segmentation, marching cubes and surface smoothing. The stages hand their
+images to each other as sitkImages, numpy views of their buffers and vtkImageData sharing the same
+buffers, instead of writing and reading back a compressed NIfTI file between every stage. The
+intermediate images are only written if a checkpoint directory is given, as uncompressed .nii.
+
+"""
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../NLM')) #ATENTION: This path depends on where you cloned our NLM repository
+
+import shutil
+import tempfile
+import importlib
+import subprocess
+import numpy as np
+import vtk
+import SimpleITK as sitk
+from biasField import shrinkBiasCorrection
+from denoising import NLM, createSITKcopy
+from runtimeConfig import getConfig
+
+recon = importlib.import_module('3dRecon')
+
+def imageToVTK(image):
+
+    """vtkImageData sharing the voxel buffer of a sitkImage (no copy), with the QForm matrix that
+    vtkNIFTIImageReader would give for the same image saved as NIfTI.
+
+    Parameters
+    ----------
+    image: sitkImage
+        Scalar 3D image.
+
+    Returns
+    -------
+    vtkImage: vtkImageData
+        Image with the spacing of image and origin at zero, as from vtkNIFTIImageReader.
+    QFormMatrix: vtkMatrix4x4
+        Transform from vtkImage coordinates to the RAS coordinates of the NIfTI qform.
+
+    """
+
+    vtkImage = recon.arrayToVTK(sitk.GetArrayViewFromImage(image), image.GetSpacing())
+    # The vtk array keeps a reference to the numpy view, which does not keep the buffer alive
+    vtkImage.GetPointData().GetScalars()._sitkImage = image
+
+    # SimpleITK direction and origin are in LPS coordinates, NIfTI ones in RAS
+    direction = np.reshape(image.GetDirection(), (3, 3))
+    QFormMatrix = vtk.vtkMatrix4x4()
+    for i in range(3):
+        sign = -1 if i < 2 else 1
+        for j in range(3):
+            QFormMatrix.SetElement(i, j, sign * direction[i, j])
+        QFormMatrix.SetElement(i, 3, sign * image.GetOrigin()[i])
+
+    return vtkImage, QFormMatrix
+
+def writeCheckpoint(checkpointDir, name, image):
+
+    """Write an intermediate image as uncompressed NIfTI, if checkpointDir is given.
+
+    Parameters
+    ----------
+    checkpointDir: string
+        Directory of the checkpoints (None to skip writing).
+    name: string
+        File name without extension.
+    image: sitkImage
+        Image to write.
+
+    Returns
+    -------
+    checkpointPath: string
+        Path to the written file (None if nothing was written).
+
+    """
+
+    if checkpointDir is None:
+        return None
+
+    os.makedirs(checkpointDir, exist_ok=True)
+    checkpointPath = os.path.join(checkpointDir, name+'.nii')
+    with getConfig().stage('writeImage'):
+        sitk.WriteImage(image, checkpointPath, False)
+
+    return checkpointPath
+
+def atroposSegmentation(image, maskImage=None, atroposPath='Atropos', numberOfClasses=2,
+                        workDir=None):
+
+    """Atropos k-means segmentation with the options of README_Atropos. Atropos is an external
+    program, so the image and the mask are handed to it as uncompressed NIfTI files in a
+    temporary directory.
+
+    Parameters
+    ----------
+    image: sitkImage
+        Denoised image.
+    maskImage: sitkImage
+        Mask of the voxels to segment (None for the whole image).
+    atroposPath: string
+        Path to the Atropos executable of ANTs.
+    numberOfClasses: int
+        Number of k-means classes.
+    workDir: string
+        Directory of the Atropos files (None for a temporary directory removed afterwards).
+
+    Returns
+    -------
+    segmentation: sitkImage
+        Label image (1 to numberOfClasses inside the mask).
+
+    """
+
+    if maskImage is None:
+        maskImage = sitk.Image(image.GetSize(), sitk.sitkUInt8) + 1
+        maskImage.CopyInformation(image)
+
+    temporaryDir = tempfile.mkdtemp(prefix='atropos') if workDir is None else workDir
+    try:
+        imagePath = writeCheckpoint(temporaryDir, 'image', image)
+        maskPath = writeCheckpoint(temporaryDir, 'mask', maskImage)
+        segmentationPath = os.path.join(temporaryDir, 'segmentation.nii')
+        with getConfig().stage('segmentation'):
+            subprocess.run([atroposPath, '-d', '3', '-a', imagePath, '-x', maskPath,
+                            '-i', 'kmeans[%d]' % numberOfClasses, '-p', 'Socrates[1]',
+                            '-m', '[0.4, 1x1x1]', '-o', segmentationPath], check=True)
+            segmentation = sitk.ReadImage(segmentationPath)
+    finally:
+        if workDir is None:
+            shutil.rmtree(temporaryDir)
+
+    return segmentation
+
+def runPipeline(inputPath, segment=atroposSegmentation, checkpointDir=None, threshold=1.5,
+                numThreads=None, dtype=None, coarseBias=False, engine='flyingEdges',
+                targetEdgeLength=None, **filterParameters):
+
+    """Bias field correction, denoising, segmentation and surface reconstruction of one sample
+    without intermediate files.
+
+    Parameters
+    ----------
+    inputPath: string
+        Path to the sample image.
+    segment: function
+        Segmentation of the denoised sitkImage, returning a label sitkImage (default: Atropos).
+    checkpointDir: string
+        If given, the intermediate images are also written there as uncompressed .nii.
+    threshold: float
+        Marching cubes threshold of the segmentation.
+    numThreads: int
+        Number of cores used by the denoising (None for the runtime configuration, see NLM).
+    dtype: dtype
+        Floating point type of the denoising (see NLM).
+    coarseBias: bool
+        Keep the bias field at the shrinked resolution (see shrinkBiasCorrection).
+    engine: string
+        Isosurface engine of applyMarchingCubes.
+    targetEdgeLength: float
+        If given, the smooth surface is also decimated to this mean edge length (see
+        applyDecimation and readCellSize).
+    filterParameters: dict
+        Parameters of applyPolyFilter (numberOfIterations, passBand, featureAngle).
+
+    Returns
+    -------
+    results: dict
+        sitkImages 'unbiased', 'bias', 'denoised' and 'segmentation', and vtkPolyData 'surface'
+        (marching cubes), 'smoothSurface' and 'decimatedSurface' (None without targetEdgeLength).
+
+    """
+
+    with getConfig().stage('readImage'):
+        image = sitk.ReadImage(inputPath)
+    dataWithoutBias, bias = shrinkBiasCorrection(image, coarseBias=coarseBias)
+    del image
+    writeCheckpoint(checkpointDir, 'unbiased', dataWithoutBias)
+    writeCheckpoint(checkpointDir, 'biasField', bias)
+
+    denoisedData = NLM(sitk.GetArrayViewFromImage(dataWithoutBias), numThreads=numThreads,
+                       dtype=dtype)
+    denoised = createSITKcopy(dataWithoutBias, denoisedData)
+    del denoisedData
+    writeCheckpoint(checkpointDir, 'denoised', denoised)
+
+    segmentation = segment(denoised)
+    writeCheckpoint(checkpointDir, 'segmentation', segmentation)
+
+    vtkImage, QFormMatrix = imageToVTK(segmentation)
+    with getConfig().stage('marchingCubes'):
+        surface = recon.applyMarchingCubes(vtkImage, threshold, True, QFormMatrix, engine=engine)
+    with getConfig().stage('smoothing'):
+        smoothSurface = recon.applyPolyFilter(surface, **filterParameters)
+    decimatedSurface = None
+    if targetEdgeLength is not None:
+        with getConfig().stage('decimation'):
+            decimatedSurface = recon.applyDecimation(smoothSurface, targetEdgeLength=targetEdgeLength)
+
+    return {'unbiased': dataWithoutBias,
+            'bias': bias,
+            'denoised': denoised,
+            'segmentation': segmentation,
+            'surface': surface,
+            'smoothSurface': smoothSurface,
+            'decimatedSurface': decimatedSurface}
+
+if __name__=='__main__':
+
+    path = os.path.abspath('/wormholeCFD/ImageProcessing')
+    sample = 'testSample'
+
+    # The segmentation needs a mask of the rock (see README_Atropos)
+    maskImage = sitk.ReadImage(path+'/testSample/testSample_mask.nii.gz')
+    results = runPipeline(path+'/testSample/testSample.nii.gz',
+                          segment=lambda image: atroposSegmentation(image, maskImage))
+
+    recon.writeSTL(path, '/testSample/cubes_'+sample+'.stl', results['surface'])
+    recon.writeSTL(path, '/testSample/smooth_'+sample+'.stl', results['smoothSurface'])
@@ -4,9 +4,9 @@ import functools
 import sys
 import numpy as np
 import numbers
-from .dtype import img_as_float
+from .dtype import img_as_float, img_as_float32, img_as_float64
 
-def convert_to_float(image, preserve_range):
+def convert_to_float(image, preserve_range, dtype=None):
     """Convert input image to float image with the appropriate range.
     Parameters
     ----------
@@ -16,15 +16,30 @@ def convert_to_float(image, preserve_range):
         Determines if the range of the image should be kept or transformed
         using img_as_float. Also see
         https://scikit-image.org/docs/dev/user_guide/data_types.html
+    dtype : {np.float32, np.float64}, optional
+        Floating point type of the output. If None, `float32` images are
+        kept and other images are converted to `float64`.
     Notes:
     ------
     * Input images with `float32` data type are not upcast.
+    * Input images already of type `dtype` are not copied.
     Returns
     -------
     image : ndarray
         Transformed version of the input.
     """
-    if preserve_range:
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError("dtype must be np.float32 or np.float64, "
+                             "got {}.".format(dtype))
+        if preserve_range:
+            image = image.astype(dtype, copy=False)
+        elif dtype == np.float32:
+            image = img_as_float32(image)
+        else:
+            image = img_as_float64(image)
+    elif preserve_range:
         # Convert image to double only if it is not single or double
         # precision float
         if image.dtype.char not in 'df':
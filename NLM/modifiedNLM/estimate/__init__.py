@@ -1,7 +1,7 @@
 """Python code for estimating a Rician standard deviation."""
 
-from .noise_estimate import rician_estimate
+from .noise_estimate import rician_estimate, rician_estimate_axes
 
 __version__ = '0.1.0'
 __author__ = 'Gustavo Solcia <gustavo.solcia@usp.br>'
-__all__ = ['rician_estimate']
+__all__ = ['rician_estimate', 'rician_estimate_axes']
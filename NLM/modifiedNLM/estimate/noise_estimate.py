@@ -8,38 +8,150 @@
 
 import numpy as np
 
-def rician_estimate(img):
+# With uniformly spaced samples the Gasser coefficients are a = b = 1/2 and
+# c = 1 / (a * a + b * b + 1) = 2/3.
+_C2 = (2. / 3.) ** 2
+
+# Number of voxels converted to float at once.
+_CHUNK_SIZE = 2 ** 22
+
+def _iter_chunks(img, overlap):
+    """Iterate over float chunks of planes along the first axis.
+
+    Parameters
+    ----------
+    img: array_like
+        Image with ``shape`` and slicing along the first axis.
+    overlap: int
+        Number of planes from the end of the previous chunk repeated at the beginning of each chunk.
+
+    Yields
+    ------
+    start: int
+        Index of the first plane of the chunk.
+    repeated: int
+        Number of planes repeated from the previous chunk.
+    chunk: array
+        Float64 chunk of planes.
+
+    """
+    n_pln = img.shape[0]
+    plane_size = int(np.prod(img.shape[1:]))
+    chunk_planes = max(overlap + 1, _CHUNK_SIZE // max(plane_size, 1))
+
+    tail = np.empty((0,) + tuple(img.shape[1:]))
+    for pln in range(0, n_pln, chunk_planes):
+        chunk = np.asarray(img[pln:pln + chunk_planes], dtype=np.float64)
+        chunk = np.concatenate([tail, chunk])
+        yield pln - len(tail), len(tail), chunk
+        tail = chunk[len(chunk) - overlap:]
+
+def rician_estimate(img, stride=1, n_samples=None, seed=None):
     """Estimate of standard deviation for Rician noise recommended by Wiest-Daesslé et al.
-    
+
     Parameters
     ----------
     img: array
-        Input nd array from image that you want to estimate the standard deviation.
+        Input nd array from image that you want to estimate the standard deviation. Any array_like
+        with ``shape`` and slicing along the first axis (e.g. a memory-mapped array) is read in
+        chunks of planes.
+    stride: int
+        Use only one pseudo-residual every ``stride`` voxels.
+    n_samples: int
+        If given, use this number of pseudo-residuals drawn at random instead of all of them.
+    seed: int
+        Seed of the random generator used with ``n_samples``.
 
     Return
     ------
     sigma_est: float
         Estimated standard deviation inspired on Theo Gasser equations.
 
+    Notes
+    -----
+    The pseudo-residuals are taken along the flattened image. Without subsampling the result is
+    the one of the original voxel by voxel loop, up to the floating point summation order.
+
     References
     ----------
-        Wiest-Daesslé N, Prima S, Coupé P, Morrissey SP, Barillot C. Rician noise removal 
-        by non-Local Means filtering for low signal-to-noise ratio MRI: applications to 
+        Wiest-Daesslé N, Prima S, Coupé P, Morrissey SP, Barillot C. Rician noise removal
+        by non-Local Means filtering for low signal-to-noise ratio MRI: applications to
         DT-MRI. Med Image Comput Comput Assist Interv. 2008;11(Pt 2):171-9.
         doi: 10.1007/978-3-540-85990-1_21. PMID: 18982603; PMCID: PMC2665702.
 
     """
 
-    X = img.reshape(-1) 
-    t=np.arange(0,len(X),1) 
-
-    size=len(X)-2
-    sigma=0
-    for i in range(1,size):
-        a = (t[i+1] - t[i]) / (t[i+1] - t[i-1])
-        b = (t[i] - t[i-1]) / (t[i+1] - t[i-1])
-        c = 1 / (a * a + b * b + 1)        
-        
-        sigma += c * c * (a * X[i-1] + b * X[i+1] - X[i]) * (a * X[i-1] + b * X[i+1] - X[i])
-    sigma_est = np.sqrt(sigma / size)
+    size = int(np.prod(img.shape)) - 2
+    # Pseudo-residuals are centered on the voxels 1 to size - 1 of the flattened image
+    if n_samples is not None:
+        rng = np.random.default_rng(seed)
+        centers = np.sort(rng.choice(size - 1, n_samples, replace=False)) + 1
+        n_residuals = n_samples
+    else:
+        n_residuals = size if stride == 1 else len(range(1, size, stride))
+
+    plane_size = int(np.prod(img.shape[1:]))
+    # The first residual of a chunk needs the last two voxels of the previous one
+    overlap = 1 if plane_size >= 2 else 2
+    next_center = 1
+    sigma = 0
+    for start, _, chunk in _iter_chunks(img, overlap=overlap):
+        X = chunk.reshape(-1)
+        base = start * plane_size
+        first = next_center
+        last = min(base + X.size - 2, size - 1)
+        if last < first:
+            continue
+        next_center = last + 1
+
+        if n_samples is not None:
+            index = centers[np.searchsorted(centers, first):
+                            np.searchsorted(centers, last, side='right')] - base
+            residuals = 0.5 * X[index - 1] + 0.5 * X[index + 1] - X[index]
+        else:
+            first += (1 - first) % stride
+            begin, end = first - base, last - base + 1
+            residuals = (0.5 * X[begin - 1:end - 1:stride] + 0.5 * X[begin + 1:end + 1:stride] -
+                         X[begin:end:stride])
+        sigma += _C2 * np.dot(residuals, residuals)
+
+    sigma_est = np.sqrt(sigma / n_residuals)
+    return sigma_est
+
+def rician_estimate_axes(img):
+    """Per-axis version of rician_estimate, the pseudo-residuals are taken along each image axis
+    instead of along the flattened image.
+
+    Parameters
+    ----------
+    img: array
+        Input nd array from image that you want to estimate the standard deviation. Any array_like
+        with ``shape`` and slicing along the first axis is read in chunks of planes.
+
+    Return
+    ------
+    sigma_est: array
+        Estimated standard deviation along each axis. Differences between axes point to
+        correlated noise, e.g. from interpolation or anisotropic filtering of the scanner.
+
+    """
+
+    ndim = len(img.shape)
+    sigma = np.zeros(ndim)
+    n_residuals = np.zeros(ndim)
+
+    for start, repeated, chunk in _iter_chunks(img, overlap=2):
+        new_planes = chunk[repeated:]
+        for axis in range(ndim):
+            X = chunk if axis == 0 else new_planes
+            if X.shape[axis] < 3:
+                continue
+            X_prev = np.take(X, np.arange(0, X.shape[axis] - 2), axis=axis)
+            X_next = np.take(X, np.arange(2, X.shape[axis]), axis=axis)
+            X_center = np.take(X, np.arange(1, X.shape[axis] - 1), axis=axis)
+            residuals = (0.5 * X_prev + 0.5 * X_next - X_center).reshape(-1)
+            sigma[axis] += _C2 * np.dot(residuals, residuals)
+            n_residuals[axis] += residuals.size
+
+    sigma_est = np.sqrt(sigma / n_residuals)
     return sigma_est
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from .. import noise_estimate
+from ..noise_estimate import rician_estimate
+
+
+def _loop_estimate(img):
+    """Original voxel by voxel loop of rician_estimate."""
+    X = img.reshape(-1)
+    size = len(X) - 2
+    sigma = 0
+    for i in range(1, size):
+        residual = 0.5 * X[i - 1] + 0.5 * X[i + 1] - X[i]
+        sigma += noise_estimate._C2 * residual * residual
+    return np.sqrt(sigma / size)
+
+
+@pytest.mark.parametrize('shape', [(5000,), (5000, 1), (1700, 3), (40, 11, 13)])
+def test_rician_estimate_chunks(monkeypatch, shape):
+    # Small chunks, so that every image is read in several of them
+    monkeypatch.setattr(noise_estimate, '_CHUNK_SIZE', 1024)
+    img = np.random.default_rng(0).normal(100, 5, shape)
+
+    np.testing.assert_allclose(rician_estimate(img), _loop_estimate(img), rtol=1e-10)
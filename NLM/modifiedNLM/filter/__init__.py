@@ -1,7 +1,10 @@
 """modifiedNLM - A modified Non-Local Means algorithm for Rician noise based on scikit-image code."""
 
-from .modified_nl_means import rician_denoise_nl_means
+from .modified_nl_means import (rician_denoise_nl_means,
+                                rician_denoise_nl_means_slabs, PaddedImage)
+from .tiled_nl_means import denoise_tiled
 
 __version__ = '0.1.0'
 __author__ = 'Gustavo Solcia <gustavo.solcia@usp.br>'
-__all__ = ['rician_denoise_nl_means']
+__all__ = ['rician_denoise_nl_means', 'rician_denoise_nl_means_slabs',
+           'PaddedImage', 'denoise_tiled']
@@ -7,6 +7,7 @@ import numpy as np
 cimport numpy as cnp
 from _shared.fast_exp cimport _fast_exp
 from libc.math cimport fabs
+from cython.parallel import prange
 from _shared.fused_numerics cimport np_floats # import para programação genérica de floats
 
 cnp.import_array()
@@ -56,20 +57,24 @@ cdef inline np_floats patch_distance_2d(np_floats [:, :, :] p1,
                 distance += w[i, j] * (tmp_diff * tmp_diff)
     return _fast_exp(-max(0.0,distance))
 
-cdef inline np_floats patch_distance_3d(np_floats [:, :, :] p1,
-                                        np_floats [:, :, :] p2,
-                                        np_floats [:, :, ::] w,
-                                        Py_ssize_t s, np_floats var) nogil:
+cdef inline np_floats patch_distance_3d(np_floats [:, :, ::1] padded,
+                                        Py_ssize_t pln, Py_ssize_t row,
+                                        Py_ssize_t col, Py_ssize_t i_pln,
+                                        Py_ssize_t i_row, Py_ssize_t i_col,
+                                        np_floats [::1] w,
+                                        Py_ssize_t s, np_floats var) noexcept nogil:
     """
     Compute a Gaussian distance between two image patches.
     Parameters
     ----------
-    p1 : 3-D array_like
-        First patch.
-    p2 : 3-D array_like
-        Second patch.
-    w : 3-D array_like
-        Array of weights for the different pixels of the patches.
+    padded : 3-D array_like
+        Padded image holding both patches, C-contiguous.
+    pln, row, col : Py_ssize_t
+        Corner of the first patch in ``padded``.
+    i_pln, i_row, i_col : Py_ssize_t
+        Corner of the second patch in ``padded``.
+    w : 1-D array_like
+        Flattened array of weights for the different pixels of the patches.
     s : Py_ssize_t
         Linear size of the patches.
     var_diff : np_floats
@@ -80,6 +85,10 @@ cdef inline np_floats patch_distance_3d(np_floats [:, :, :] p1,
         Gaussian distance between the two patches
     Notes
     -----
+    The patches are given by their corners rather than as memoryview
+    slices, so that the function can be called inside a ``prange`` loop.
+    Each patch row is read through a pointer to contiguous memory, and the
+    cutoff is checked after every row of the first ``s - 1`` planes.
     The returned distance is given by
     .. math::  \exp( -w ((p1 - p2)^2 - 2*var))
     """
@@ -88,32 +97,165 @@ cdef inline np_floats patch_distance_3d(np_floats [:, :, :] p1,
     cdef np_floats DISTANCE_CUTOFF = 5.0
     cdef np_floats distance = 0
     cdef np_floats tmp_diff
+    cdef np_floats *p1
+    cdef np_floats *p2
+    cdef np_floats *w_row = &w[0]
 
     for i in range(s):
-        # exp of large negative numbers will be 0, so we'd better stop
-        if distance > DISTANCE_CUTOFF:
-            return 0.
         for j in range(s):
+            p1 = &padded[pln + i, row + j, col]
+            p2 = &padded[i_pln + i, i_row + j, i_col]
             for k in range(s):
-                tmp_diff = p1[i, j, k] - p2[i, j, k]
-                distance += w[i, j, k] * (tmp_diff * tmp_diff)
+                tmp_diff = p1[k] - p2[k]
+                distance += w_row[k] * (tmp_diff * tmp_diff)
+            # exp of large negative numbers will be 0, so we'd better stop.
+            # The partial sums only grow, so stopping at any row before the
+            # last plane gives the same result as checking once per plane.
+            if i < s - 1 and distance > DISTANCE_CUTOFF:
+                return 0.
+            w_row += s
     return _fast_exp(-fabs(distance))
 
-def _RICE_nl_means_denoising_2d(cnp.ndarray[np_floats, ndim=3] image, Py_ssize_t s,
-                           Py_ssize_t d, double h, double var):
+cdef inline bint _preselected(np_floats [:, :, ::1] means,
+                              np_floats [:, :, ::1] variances,
+                              Py_ssize_t pln, Py_ssize_t row, Py_ssize_t col,
+                              Py_ssize_t i_pln, Py_ssize_t i_row,
+                              Py_ssize_t i_col, np_floats mean_ratio,
+                              np_floats var_ratio) noexcept nogil:
+    """
+    Check whether two patches are similar enough, by their local statistics,
+    for their distance to be computed.
+    Parameters
+    ----------
+    means, variances : 3-D array_like
+        Mean and variance of the patch centered on each voxel.
+    pln, row, col : Py_ssize_t
+        Center of the first patch.
+    i_pln, i_row, i_col : Py_ssize_t
+        Center of the second patch.
+    mean_ratio, var_ratio : np_floats
+        Lower bounds of the ratios of the means and of the variances, whose
+        inverses are the upper bounds.
+    Returns
+    -------
+    preselected : bint
+        True if both ratios are within their bounds.
+    """
+    cdef np_floats m1 = means[pln, row, col]
+    cdef np_floats m2 = means[i_pln, i_row, i_col]
+    cdef np_floats v1 = variances[pln, row, col]
+    cdef np_floats v2 = variances[i_pln, i_row, i_col]
+    return (m1 >= mean_ratio * m2 and m2 >= mean_ratio * m1 and
+            v1 >= var_ratio * v2 and v2 >= var_ratio * v1)
+
+cdef Py_ssize_t _nl_means_denoising_plane_3d(np_floats [:, :, ::1] padded,
+                                             np_floats [:, :, :] result,
+                                             np_floats [::1] w,
+                                             Py_ssize_t pln, Py_ssize_t s,
+                                             Py_ssize_t d, np_floats var,
+                                             bint preselect,
+                                             np_floats [:, :, ::1] means,
+                                             np_floats [:, :, ::1] variances,
+                                             np_floats mean_ratio,
+                                             np_floats var_ratio) noexcept nogil:
+    """
+    Denoise a single plane of a 3-D array with the classic algorithm.
+    Parameters
+    ----------
+    padded : 3-D array_like
+        Input data padded by ``s // 2`` on every side.
+    result : 3-D array_like
+        Output of the function, the plane ``pln`` is filled.
+    w : 1-D array_like
+        Flattened array of weights for the different pixels of the patches.
+    pln : Py_ssize_t
+        Index of the plane to denoise.
+    s : Py_ssize_t
+        Linear size of the patches.
+    d : Py_ssize_t
+        Maximal distance in pixels where to search patches used for denoising.
+    var : np_floats
+        The double of the expected noise variance.
+    preselect : bint
+        Whether to skip the patches rejected by `_preselected`.
+    means, variances, mean_ratio, var_ratio :
+        Arguments of `_preselected`.
+    Returns
+    -------
+    n_skipped : Py_ssize_t
+        Number of patch distances skipped by the pre-selection.
+    Notes
+    -----
+    ``new_value`` and ``weight_sum`` are local to this function, so each
+    OpenMP thread accumulates in its own variables.
+    """
+    cdef Py_ssize_t n_pln, n_row, n_col
+    n_pln, n_row, n_col = result.shape[0], result.shape[1], result.shape[2]
+    cdef Py_ssize_t i_start, i_end, j_start, j_end, k_start, k_end
+    cdef Py_ssize_t row, col, i, j, k
+    cdef Py_ssize_t offset = s / 2
+    cdef Py_ssize_t n_skipped = 0
+    cdef np_floats new_value
+    cdef np_floats weight_sum, weight
+
+    i_start = pln - min(d, pln)
+    i_end = pln + min(d + 1, n_pln - pln)
+    # Iterate over rows, taking padding into account
+    for row in range(n_row):
+        j_start = row - min(d, row)
+        j_end = row + min(d + 1, n_row - row)
+        # Iterate over columns, taking padding into account
+        for col in range(n_col):
+            k_start = col - min(d, col)
+            k_end = col + min(d + 1, n_col - col)
+
+            new_value = 0
+            weight_sum = 0
+
+            # Iterate over local 3d patch for each pixel
+            for i in range(i_start, i_end):
+                for j in range(j_start, j_end):
+                    for k in range(k_start, k_end):
+                        if preselect and not _preselected[np_floats](
+                                means, variances, pln, row, col, i, j, k,
+                                mean_ratio, var_ratio):
+                            n_skipped += 1
+                            continue
+                        weight = patch_distance_3d[np_floats](
+                            padded, pln, row, col, i, j, k, w, s, var)
+                        # Collect results in weight sum
+                        weight_sum += weight
+#                        new_value += weight * padded[i+offset, <<< ORIGINAL
+#                                                     j+offset,
+#                                                     k+offset]
+                        new_value += weight * padded[i+offset, # Rician Mod
+                                                     j+offset,
+                                                     k+offset] * padded[i+offset,
+                                                     j+offset,
+                                                     k+offset]
+
+            # Normalize the result
+#            result[pln, row, col] = new_value / weight_sum <<< ORIGINAL
+            result[pln, row, col] = (new_value/weight_sum -var*var)**0.5  # Rician mod
+
+    return n_skipped
+
+def _RICE_nl_means_denoising_2d(np_floats [:, :, ::1] padded, Py_ssize_t s,
+                           Py_ssize_t d, np_floats [:, ::1] w, double var):
     """
     Perform non-local means denoising on 2-D RGB image
     Parameters
     ----------
-    image : ndarray
-        Input RGB image to be denoised
+    padded : ndarray
+        Input RGB image to be denoised, padded by ``s // 2`` along the
+        first two axes.
     s : Py_ssize_t, optional
         Size of patches used for denoising
     d : Py_ssize_t, optional
         Maximal distance in pixels where to search patches used for denoising
-    h : np_floats, optional
-        Cut-off distance (in gray levels). The higher h, the more permissive
-        one is in accepting patches.
+    w : ndarray
+        Gaussian weights of the patch pixels, normalized by the number of
+        channels and by the squared cut-off distance ``h``.
     var : np_floats
         Expected noise variance.  If non-zero, this is used to reduce the
         apparent patch distances by the expected distance due to the noise.
@@ -125,7 +267,7 @@ def _RICE_nl_means_denoising_2d(cnp.ndarray[np_floats, ndim=3] image, Py_ssize_t
     Returns
     -------
     result : ndarray
-        Denoised image, of same shape as input image.
+        Denoised image, of same shape as the unpadded input image.
     """
 
     if s % 2 == 0:
@@ -136,26 +278,18 @@ def _RICE_nl_means_denoising_2d(cnp.ndarray[np_floats, ndim=3] image, Py_ssize_t
     else:
         dtype = np.float64
 
-    cdef Py_ssize_t n_row, n_col, n_channels
-    n_row, n_col, n_channels = image.shape[0], image.shape[1], image.shape[2]
     cdef Py_ssize_t offset = s / 2
+    cdef Py_ssize_t n_row, n_col, n_channels
+    n_row, n_col, n_channels = (padded.shape[0] - 2 * offset,
+                                padded.shape[1] - 2 * offset,
+                                padded.shape[2])
     cdef Py_ssize_t row, col, i, j, channel, i_start, i_end, j_start, j_end
     cdef np_floats[::1] new_values = np.zeros(n_channels, dtype=dtype)
-    cdef np_floats[:, :, ::1] padded = np.ascontiguousarray(
-        np.pad(image, ((offset, offset), (offset, offset), (0, 0)),
-               mode='reflect'))
-    cdef np_floats [:, :, ::1] result = np.empty_like(image)
+    cdef np_floats [:, :, ::1] result = np.empty((n_row, n_col, n_channels),
+                                                 dtype=dtype)
     cdef np_floats new_value
     cdef np_floats weight_sum, weight
 
-    cdef np_floats A = ((s - 1.) / 4.)
-    cdef np_floats [::1] range_vals = np.arange(-offset, offset + 1,
-                                                dtype=dtype)
-    xg_row, xg_col = np.meshgrid(range_vals, range_vals, indexing='ij')
-    cdef np_floats [:, ::1] w = np.ascontiguousarray(
-        np.exp(-(xg_row * xg_row + xg_col * xg_col) / (2 * A * A)))
-    w *= 1. / (n_channels * np.sum(w) * h *h )
-
     cdef np_floats [:, :, :] central_patch
     var *= 2
 
@@ -201,28 +335,43 @@ def _RICE_nl_means_denoising_2d(cnp.ndarray[np_floats, ndim=3] image, Py_ssize_t
 
     return np.squeeze(np.asarray(result))
 
-def _RICE_nl_means_denoising_3d(cnp.ndarray[np_floats, ndim=3] image,
+def _RICE_nl_means_denoising_3d(np_floats [:, :, ::1] padded,
                            Py_ssize_t s, Py_ssize_t d,
-                           double h, double var):
+                           np_floats [::1] w, double var,
+                           int num_threads=1, means=None, variances=None,
+                           double mean_ratio=0.95, double var_ratio=0.5):
     """
     Perform non-local means denoising on 3-D array
     Parameters
     ----------
-    image : ndarray
-        Input data to be denoised.
+    padded : ndarray
+        Input data to be denoised, padded by ``s // 2`` on every side.
     s : int, optional
         Size of patches used for denoising.
     d : Py_ssize_t, optional
         Maximal distance in pixels where to search patches used for denoising.
-    h : np_floats, optional
-        Cut-off distance (in gray levels).
+    w : ndarray
+        Flattened Gaussian weights of the patch pixels, normalized by the
+        squared cut-off distance ``h``.
     var : np_floats
         Expected noise variance.  If non-zero, this is used to reduce the
         apparent patch distances by the expected distance due to the noise.
+    num_threads : int, optional
+        Number of OpenMP threads sharing the planes of the image.
+    means, variances : ndarray, optional
+        Mean and variance of the patch centered on each voxel. If given, the
+        distance to a patch is only computed if the ratios of the means and
+        of the variances of the two patches are between `mean_ratio` and
+        ``1 / mean_ratio``, and `var_ratio` and ``1 / var_ratio``.
+    mean_ratio, var_ratio : double, optional
+        Thresholds of the pre-selection.
     Returns
     -------
     result : ndarray
-        Denoised image, of same shape as input image.
+        Denoised image, of same shape as the unpadded input image.
+    n_skipped : int
+        Number of patch distances skipped by the pre-selection, only
+        returned if `means` is given.
     """
 
     if s % 2 == 0:
@@ -233,72 +382,646 @@ def _RICE_nl_means_denoising_3d(cnp.ndarray[np_floats, ndim=3] image,
     else:
         dtype = np.float64
 
+    cdef Py_ssize_t offset = s / 2
+    cdef Py_ssize_t n_pln = padded.shape[0] - 2 * offset
+    cdef Py_ssize_t pln
+    cdef np_floats [:, :, :] result = np.empty(
+        (n_pln, padded.shape[1] - 2 * offset, padded.shape[2] - 2 * offset),
+        dtype=dtype)
+
+    cdef np_floats var_diff = 2 * var
+    cdef bint preselect = means is not None
+    cdef np_floats [:, :, ::1] means_view, variances_view
+    if preselect:
+        means_view, variances_view = means, variances
+    else:
+        means_view = variances_view = np.zeros((1, 1, 1), dtype=dtype)
+    cdef Py_ssize_t n_skipped = 0
+
+    # Iterate over planes, each thread denoising whole planes
+    with nogil:
+        for pln in prange(n_pln, num_threads=num_threads,
+                          schedule='dynamic'):
+            n_skipped += _nl_means_denoising_plane_3d[np_floats](
+                padded, result, w, pln, s, d, var_diff, preselect,
+                means_view, variances_view, mean_ratio, var_ratio)
+
+    if preselect:
+        return np.asarray(result), n_skipped
+    return np.asarray(result)
+
+cdef Py_ssize_t _nl_means_denoising_block_plane_3d(np_floats [:, :, ::1] padded,
+                                                   np_floats [:, :, ::1] acc,
+                                                   np_floats [:, :, ::1] count,
+                                                   np_floats [:, ::1] blocks,
+                                                   np_floats [::1] w,
+                                                   Py_ssize_t [::1] pln_centers,
+                                                   Py_ssize_t [::1] row_centers,
+                                                   Py_ssize_t [::1] col_centers,
+                                                   Py_ssize_t m, Py_ssize_t s,
+                                                   Py_ssize_t d, np_floats var,
+                                                   bint preselect,
+                                                   np_floats [:, :, ::1] means,
+                                                   np_floats [:, :, ::1] variances,
+                                                   np_floats mean_ratio,
+                                                   np_floats var_ratio) noexcept nogil:
+    """
+    Restore the blocks centered on one plane of the block grid with the
+    classic algorithm, and add them to the aggregation arrays.
+    Parameters
+    ----------
+    padded : 3-D array_like
+        Input data padded by ``s // 2`` on every side, C-contiguous.
+    acc : 3-D array_like
+        Sum of the restored blocks covering each voxel.
+    count : 3-D array_like
+        Number of restored blocks covering each voxel.
+    blocks : 2-D array_like
+        Buffer of ``s ** 3`` values for each plane of the block grid.
+    w : 1-D array_like
+        Flattened array of weights for the different pixels of the blocks.
+    pln_centers, row_centers, col_centers : 1-D array_like
+        Coordinates of the block grid along each axis.
+    m : Py_ssize_t
+        Index of the plane of the block grid.
+    s : Py_ssize_t
+        Linear size of the blocks.
+    d : Py_ssize_t
+        Maximal distance in pixels where to search blocks used for denoising.
+    var : np_floats
+        The double of the expected noise variance.
+    preselect : bint
+        Whether to skip the blocks rejected by `_preselected`.
+    means, variances, mean_ratio, var_ratio :
+        Arguments of `_preselected`.
+    Returns
+    -------
+    n_skipped : Py_ssize_t
+        Number of block distances skipped by the pre-selection.
+    Notes
+    -----
+    The blocks of planes ``m`` and ``m'`` of the grid do not overlap if
+    their centers are at least ``s`` planes apart, so such planes can be
+    restored by different threads.
+    """
     cdef Py_ssize_t n_pln, n_row, n_col
-    n_pln, n_row, n_col = image.shape[0], image.shape[1], image.shape[2]
+    n_pln, n_row, n_col = acc.shape[0], acc.shape[1], acc.shape[2]
     cdef Py_ssize_t i_start, i_end, j_start, j_end, k_start, k_end
-    cdef Py_ssize_t pln, row, col, i, j, k
+    cdef Py_ssize_t pln, row, col, r, c, i, j, k, a, b, e, t, x, y, z
     cdef Py_ssize_t offset = s / 2
-    # padd the image so that boundaries are denoised as well
-    cdef np_floats [:, :, :] padded = np.ascontiguousarray(
-        np.pad(image, offset, mode='reflect'))
-    cdef np_floats [:, :, :] result = np.empty_like(image)
-    cdef np_floats new_value
+    cdef Py_ssize_t block_size = s * s * s
+    cdef Py_ssize_t n_skipped = 0
+    cdef np_floats *block = &blocks[m, 0]
+    cdef np_floats *p
     cdef np_floats weight_sum, weight
 
-    cdef np_floats A = ((s - 1.) / 4.)
-    cdef np_floats [::] range_vals = np.arange(-offset, offset + 1,
-                                               dtype=dtype)
-    xg_pln, xg_row, xg_col = np.meshgrid(range_vals, range_vals, range_vals,
-                                         indexing='ij')
-    cdef np_floats [:, :, ::1] w = np.ascontiguousarray(
-        np.exp(-(xg_pln * xg_pln + xg_row * xg_row + xg_col * xg_col) /
-               (2 * A * A)))
-    w *= 1. / (np.sum(w) * h * h)
+    pln = pln_centers[m]
+    i_start = pln - min(d, pln)
+    i_end = pln + min(d + 1, n_pln - pln)
+    for r in range(row_centers.shape[0]):
+        row = row_centers[r]
+        j_start = row - min(d, row)
+        j_end = row + min(d + 1, n_row - row)
+        for c in range(col_centers.shape[0]):
+            col = col_centers[c]
+            k_start = col - min(d, col)
+            k_end = col + min(d + 1, n_col - col)
 
-    cdef np_floats [:, :, :] central_patch
+            for t in range(block_size):
+                block[t] = 0
+            weight_sum = 0
+
+            # Iterate over local 3d neighbourhood of the block center
+            for i in range(i_start, i_end):
+                for j in range(j_start, j_end):
+                    for k in range(k_start, k_end):
+                        if preselect and not _preselected[np_floats](
+                                means, variances, pln, row, col, i, j, k,
+                                mean_ratio, var_ratio):
+                            n_skipped += 1
+                            continue
+                        weight = patch_distance_3d[np_floats](
+                            padded, pln, row, col, i, j, k, w, s, var)
+                        if weight == 0:
+                            continue
+                        weight_sum += weight
+                        # Weighted sum of the squared blocks (Rician mod)
+                        t = 0
+                        for a in range(s):
+                            for b in range(s):
+                                p = &padded[i + a, j + b, k]
+                                for e in range(s):
+                                    block[t] += weight * p[e] * p[e]
+                                    t += 1
+
+            # Add the restored block to the voxels it covers
+            t = 0
+            for a in range(s):
+                x = pln - offset + a
+                for b in range(s):
+                    y = row - offset + b
+                    for e in range(s):
+                        z = col - offset + e
+                        if (0 <= x < n_pln and 0 <= y < n_row and
+                                0 <= z < n_col):
+                            acc[x, y, z] += block[t] / weight_sum
+                            count[x, y, z] += 1
+                        t += 1
+
+    return n_skipped
+
+def _RICE_blockwise_nl_means_denoising_3d(np_floats [:, :, ::1] padded,
+                                          Py_ssize_t s, Py_ssize_t d,
+                                          np_floats [::1] w, double var,
+                                          Py_ssize_t step=2,
+                                          int num_threads=1, means=None,
+                                          variances=None,
+                                          double mean_ratio=0.95,
+                                          double var_ratio=0.5):
+    """
+    Perform blockwise non-local means denoising on 3-D array
+    Parameters
+    ----------
+    padded : ndarray
+        Input data to be denoised, padded by ``s // 2`` on every side.
+    s : int, optional
+        Size of blocks used for denoising.
+    d : Py_ssize_t, optional
+        Maximal distance in pixels where to search blocks used for denoising.
+    w : ndarray
+        Flattened Gaussian weights of the block pixels, normalized by the
+        squared cut-off distance ``h``.
+    var : np_floats
+        Expected noise variance.  If non-zero, this is used to reduce the
+        apparent patch distances by the expected distance due to the noise.
+    step : Py_ssize_t, optional
+        Distance between the centers of the restored blocks, between 1 and
+        ``s``.
+    num_threads : int, optional
+        Number of OpenMP threads sharing the planes of the block grid.
+    means, variances, mean_ratio, var_ratio : optional
+        Pre-selection of the blocks, see `_RICE_nl_means_denoising_3d`.
+    Returns
+    -------
+    result : ndarray
+        Denoised image, of same shape as the unpadded input image.
+    n_skipped : int
+        Number of block distances skipped by the pre-selection, only
+        returned if `means` is given.
+    Notes
+    -----
+    Whole blocks are restored on a grid of centers spaced by `step`, and
+    each voxel takes the mean of the restored blocks covering it [1]_. The
+    mean is taken over the weighted averages of the squared intensities,
+    and the Rician bias is removed once per voxel as in the voxelwise
+    kernel.
+    References
+    ----------
+    .. [1] P. Coupé, P. Yger, S. Prima, P. Hellier, C. Kervrann and C.
+           Barillot, An Optimized Blockwise Nonlocal Means Denoising Filter
+           for 3-D Magnetic Resonance Images, IEEE Transactions on Medical
+           Imaging, 2008, vol. 27, pp. 425-441.
+           :DOI:`10.1109/TMI.2007.906087`
+    """
+
+    if s % 2 == 0:
+        s += 1  # odd value for symmetric patch
+    if step < 1 or step > s:
+        raise ValueError("The block step must be between 1 and the patch "
+                         "size.")
+
+    if np_floats is cnp.float32_t:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+
+    cdef Py_ssize_t offset = s / 2
+    cdef Py_ssize_t n_pln, n_row, n_col
+    n_pln, n_row, n_col = (padded.shape[0] - 2 * offset,
+                           padded.shape[1] - 2 * offset,
+                           padded.shape[2] - 2 * offset)
+
+    # Grid of block centers, with a last center covering the image end
+    centers = []
+    for n in (n_pln, n_row, n_col):
+        axis_centers = np.arange(0, n, step, dtype=np.intp)
+        if (n - 1) % step > offset:
+            axis_centers = np.append(axis_centers, n - 1)
+        centers.append(axis_centers)
+    cdef Py_ssize_t [::1] pln_centers = centers[0]
+    cdef Py_ssize_t [::1] row_centers = centers[1]
+    cdef Py_ssize_t [::1] col_centers = centers[2]
+    # Planes m and m + n_phases of the regular grid do not overlap
+    cdef Py_ssize_t n_regular = (n_pln + step - 1) // step
+    cdef Py_ssize_t n_phases = (s + step - 1) // step
+    cdef Py_ssize_t m, phase, x, y, z
+
+    cdef np_floats [:, :, ::1] acc = np.zeros((n_pln, n_row, n_col),
+                                              dtype=dtype)
+    cdef np_floats [:, :, ::1] count = np.zeros((n_pln, n_row, n_col),
+                                                dtype=dtype)
+    cdef np_floats [:, ::1] blocks = np.empty(
+        (pln_centers.shape[0], s * s * s), dtype=dtype)
+    cdef np_floats var_diff = 2 * var
+    cdef bint preselect = means is not None
+    cdef np_floats [:, :, ::1] means_view, variances_view
+    if preselect:
+        means_view, variances_view = means, variances
+    else:
+        means_view = variances_view = np.zeros((1, 1, 1), dtype=dtype)
+    cdef Py_ssize_t n_skipped = 0
+
+    with nogil:
+        for phase in range(n_phases):
+            for m in prange(phase, n_regular, n_phases,
+                            num_threads=num_threads, schedule='dynamic'):
+                n_skipped += _nl_means_denoising_block_plane_3d[np_floats](
+                    padded, acc, count, blocks, w, pln_centers, row_centers,
+                    col_centers, m, s, d, var_diff, preselect, means_view,
+                    variances_view, mean_ratio, var_ratio)
+        for m in range(n_regular, pln_centers.shape[0]):
+            n_skipped += _nl_means_denoising_block_plane_3d[np_floats](
+                padded, acc, count, blocks, w, pln_centers, row_centers,
+                col_centers, m, s, d, var_diff, preselect, means_view,
+                variances_view, mean_ratio, var_ratio)
+
+        # Normalize the result
+        for x in range(n_pln):
+            for y in range(n_row):
+                for z in range(n_col):
+                    acc[x, y, z] = (acc[x, y, z] / count[x, y, z] -
+                                    var_diff * var_diff)**0.5  # Rician mod
+
+    if preselect:
+        return np.asarray(acc), n_skipped
+    return np.asarray(acc)
+
+cdef inline void _integral_image_2d(np_floats [:, :, ::1] padded,
+                                    double [:, ::1] integral,
+                                    Py_ssize_t t_row, Py_ssize_t t_col,
+                                    Py_ssize_t n_row, Py_ssize_t n_col,
+                                    Py_ssize_t n_channels,
+                                    np_floats var_diff) noexcept nogil:
+    """
+    Compute the integral of the squared difference between an image
+    ``padded`` and the same image shifted by ``(t_row, t_col)``.
+    Parameters
+    ----------
+    padded : ndarray of shape (n_row, n_col, n_channels)
+        Image of interest.
+    integral : ndarray of float64
+        Output of the function. The array is filled with integral values.
+        ``integral`` should have the same shape as ``padded``. It is kept in
+        double precision for float32 images too, since the cumulative sums
+        grow with the image size while patch distances do not.
+    t_row : Py_ssize_t
+        Shift along the row axis.
+    t_col : Py_ssize_t
+        Shift along the column axis (positive value).
+    n_row : Py_ssize_t
+    n_col : Py_ssize_t
+    n_channels : Py_ssize_t
+    var_diff : np_floats
+        The double of the expected noise variance.  If non-zero, this
+        is used to reduce the apparent patch distances by the expected
+        distance due to the noise.
+    """
+    cdef Py_ssize_t row, col, channel
+    cdef Py_ssize_t row_start = max(1, -t_row)
+    cdef Py_ssize_t row_end = min(n_row, n_row - t_row)
+    cdef np_floats tmp_diff
+    cdef double distance
+
+    for row in range(row_start, row_end):
+        for col in range(1, n_col - t_col):
+            distance = 0
+            for channel in range(n_channels):
+                tmp_diff = (padded[row, col, channel] -
+                            padded[row + t_row, col + t_col, channel])
+                distance += tmp_diff * tmp_diff
+            distance -= n_channels * var_diff
+            integral[row, col] = (distance +
+                                  integral[row - 1, col] +
+                                  integral[row, col - 1] -
+                                  integral[row - 1, col - 1])
+
+cdef inline void _integral_image_3d(np_floats [:, :, ::1] padded,
+                                    double [:, :, ::1] integral,
+                                    Py_ssize_t t_pln, Py_ssize_t t_row,
+                                    Py_ssize_t t_col, Py_ssize_t n_pln,
+                                    Py_ssize_t n_row, Py_ssize_t n_col,
+                                    np_floats var_diff) noexcept nogil:
+    """
+    Compute the integral of the squared difference between an image
+    ``padded`` and the same image shifted by ``(t_pln, t_row, t_col)``.
+    Parameters
+    ----------
+    padded : ndarray of shape (n_pln, n_row, n_col)
+        Image of interest.
+    integral : ndarray of float64
+        Output of the function. The array is filled with integral values.
+        ``integral`` should have the same shape as ``padded``. It is kept in
+        double precision for float32 images too, since the cumulative sums
+        grow with the image size while patch distances do not.
+    t_pln : Py_ssize_t
+        Shift along the plane axis.
+    t_row : Py_ssize_t
+        Shift along the row axis.
+    t_col : Py_ssize_t
+        Shift along the column axis (positive value).
+    n_pln : Py_ssize_t
+    n_row : Py_ssize_t
+    n_col : Py_ssize_t
+    var_diff : np_floats
+        The double of the expected noise variance.  If non-zero, this
+        is used to reduce the apparent patch distances by the expected
+        distance due to the noise.
+    """
+    cdef Py_ssize_t pln, row, col
+    cdef Py_ssize_t pln_start = max(1, -t_pln)
+    cdef Py_ssize_t pln_end = min(n_pln, n_pln - t_pln)
+    cdef Py_ssize_t row_start = max(1, -t_row)
+    cdef Py_ssize_t row_end = min(n_row, n_row - t_row)
+    cdef np_floats tmp_diff
+
+    for pln in range(pln_start, pln_end):
+        for row in range(row_start, row_end):
+            for col in range(1, n_col - t_col):
+                tmp_diff = (padded[pln, row, col] -
+                            padded[pln + t_pln, row + t_row, col + t_col])
+                integral[pln, row, col] = (tmp_diff * tmp_diff - var_diff +
+                                           integral[pln - 1, row, col] +
+                                           integral[pln, row - 1, col] +
+                                           integral[pln, row, col - 1] +
+                                           integral[pln - 1, row - 1, col - 1] -
+                                           integral[pln - 1, row - 1, col] -
+                                           integral[pln, row - 1, col - 1] -
+                                           integral[pln - 1, row, col - 1])
+
+cdef inline np_floats _integral_to_distance_2d(double [:, ::1] integral,
+                                               Py_ssize_t row, Py_ssize_t col,
+                                               Py_ssize_t offset,
+                                               np_floats h2s2) noexcept nogil:
+    """
+    References
+    ----------
+    J. Darbon, A. Cunha, T.F. Chan, S. Osher, and G.J. Jensen, Fast
+    nonlocal filtering applied to electron cryomicroscopy, in 5th IEEE
+    International Symposium on Biomedical Imaging: From Nano to Macro,
+    2008, pp. 1331-1334.
+    Jacques Froment. Parameter-Free Fast Pixelwise Non-Local Means
+    Denoising. Image Processing On Line, 2014, vol. 4, pp. 300-326.
+    """
+    cdef double distance
+    distance = (integral[row + offset, col + offset] +
+                integral[row - offset - 1, col - offset - 1] -
+                integral[row - offset - 1, col + offset] -
+                integral[row + offset, col - offset - 1])
+    return max(distance, 0.0) / h2s2
+
+cdef inline np_floats _integral_to_distance_3d(double [:, :, ::1] integral,
+                                               Py_ssize_t pln, Py_ssize_t row,
+                                               Py_ssize_t col,
+                                               Py_ssize_t offset,
+                                               np_floats s_cube_h_square) noexcept nogil:
+    """
+    References
+    ----------
+    J. Darbon, A. Cunha, T.F. Chan, S. Osher, and G.J. Jensen, Fast
+    nonlocal filtering applied to electron cryomicroscopy, in 5th IEEE
+    International Symposium on Biomedical Imaging: From Nano to Macro,
+    2008, pp. 1331-1334.
+    Jacques Froment. Parameter-Free Fast Pixelwise Non-Local Means
+    Denoising. Image Processing On Line, 2014, vol. 4, pp. 300-326.
+    """
+    cdef double distance
+    distance = (integral[pln + offset, row + offset, col + offset] -
+                integral[pln - offset - 1, row - offset - 1, col - offset - 1] +
+                integral[pln - offset - 1, row - offset - 1, col + offset] +
+                integral[pln - offset - 1, row + offset, col - offset - 1] +
+                integral[pln + offset, row - offset - 1, col - offset - 1] -
+                integral[pln - offset - 1, row + offset, col + offset] -
+                integral[pln + offset, row - offset - 1, col + offset] -
+                integral[pln + offset, row + offset, col - offset - 1])
+    return max(distance, 0.0) / s_cube_h_square
+
+def _RICE_fast_nl_means_denoising_2d(np_floats [:, :, ::1] padded,
+                                     Py_ssize_t s, Py_ssize_t d,
+                                     double h, double var):
+    """
+    Perform fast non-local means denoising on 2-D array, with the outer
+    loop on patch shifts in order to reduce the number of operations.
+    Parameters
+    ----------
+    padded : ndarray
+        2-D input data to be denoised, grayscale or RGB, padded by
+        ``s // 2 + d + 1`` along the first two axes.
+    s : Py_ssize_t, optional
+        Size of patches used for denoising.
+    d : Py_ssize_t, optional
+        Maximal distance in pixels where to search patches used for denoising.
+    h : np_floats, optional
+        Cut-off distance (in gray levels). The higher h, the more permissive
+        one is in accepting patches.
+    var : np_floats
+        Expected noise variance.  If non-zero, this is used to reduce the
+        apparent patch distances by the expected distance due to the noise.
+    Notes
+    -----
+    The weighted average accumulates the squared intensities, and the
+    result is corrected by the Rician bias as in the classic kernel.
+    Returns
+    -------
+    result : ndarray
+        Denoised image, of same shape as the unpadded input image.
+    """
+    if s % 2 == 0:
+        s += 1  # odd value for symmetric patch
+
+    cdef Py_ssize_t offset = s / 2
+    # Image padding: we need to account for patch size, possible shift,
+    # + 1 for the boundary effects in finite differences
+    cdef Py_ssize_t pad_size = offset + d + 1
+    padded_array = np.asarray(padded)
+    cdef np_floats [:, :, ::1] result = np.zeros_like(padded_array)
+    cdef np_floats [:, ::1] weights = np.zeros_like(padded_array[..., 0])
+    cdef double [:, ::1] integral = np.zeros(padded_array.shape[:2],
+                                             dtype=np.float64)
+    cdef Py_ssize_t n_row, n_col, n_channels
+    cdef Py_ssize_t t_row, t_col, row, col, channel
+    cdef Py_ssize_t row_dist_min, row_dist_max, col_dist_max
+    cdef np_floats DISTANCE_CUTOFF = 5.0
+    cdef np_floats weight, distance, alpha
+    n_row, n_col, n_channels = (padded.shape[0], padded.shape[1],
+                                padded.shape[2])
+    cdef np_floats h2s2 = n_channels * h * h * s * s
     var *= 2
 
-    # Iterate over planes, taking padding into account
     with nogil:
-        for pln in range(n_pln):
-            i_start = pln - min(d, pln)
-            i_end = pln + min(d + 1, n_pln - pln)
-            # Iterate over rows, taking padding into account
-            for row in range(n_row):
-                j_start = row - min(d, row)
-                j_end = row + min(d + 1, n_row - row)
-                # Iterate over columns, taking padding into account
-                for col in range(n_col):
-                    k_start = col - min(d, col)
-                    k_end = col + min(d + 1, n_col - col)
-
-                    central_patch = padded[pln:pln+s, row:row+s, col:col+s]
-
-                    new_value = 0
-                    weight_sum = 0
-
-                    # Iterate over local 3d patch for each pixel
-                    for i in range(i_start, i_end):
-                        for j in range(j_start, j_end):
-                            for k in range(k_start, k_end):
-                                weight = patch_distance_3d[np_floats](
-                                    central_patch,
-                                    padded[i:i+s, j:j+s, k:k+s],
-                                    w, s, var)
-                                # Collect results in weight sum
-                                weight_sum += weight
-#                                new_value += weight * padded[i+offset, <<< ORIGINAL
-#                                                             j+offset,
-#                                                             k+offset]
-                                new_value += weight * padded[i+offset, # Rician Mod
-                                                             j+offset,
-                                                             k+offset] * padded[i+offset, 
-                                                             j+offset,
-                                                             k+offset]
-
-                    # Normalize the result
-#                    result[pln, row, col] = new_value / weight_sum <<< ORIGINAL
-                    result[pln, row, col] = (new_value/weight_sum -var*var)**0.5  # Rician mod
-            #        result[row, col, channel] = (new_values[channel] / weight_sum - var * var)**0.5
+        # Outer loops on patch shifts
+        # With t_col >= 0, reference patch is always on the left of test patch
+        for t_row in range(-d, d + 1):
+            row_dist_min = max(offset + 1, offset + 1 - t_row)
+            row_dist_max = min(n_row - offset - 1, n_row - offset - 1 - t_row)
+            for t_col in range(0, d + 1):
+                col_dist_max = n_col - offset - 1 - t_col
+                # alpha is to account for patches on the same column
+                # distance is computed twice in this case
+                if t_col == 0:
+                    alpha = 0.5
+                else:
+                    alpha = 1.
+                _integral_image_2d[np_floats](padded, integral, t_row, t_col,
+                                              n_row, n_col, n_channels, var)
 
-    return np.asarray(result)
+                # Inner loops on pixel coordinates
+                for row in range(row_dist_min, row_dist_max):
+                    for col in range(offset + 1, col_dist_max):
+                        distance = _integral_to_distance_2d[np_floats](
+                            integral, row, col, offset, h2s2)
+                        # exp of large negative numbers is close to zero
+                        if distance > DISTANCE_CUTOFF:
+                            continue
+                        weight = alpha * _fast_exp(-distance)
+                        # Accumulate weights corresponding to different shifts
+                        weights[row, col] += weight
+                        weights[row + t_row, col + t_col] += weight
+                        # Apply to each channel multiplicatively (Rician mod)
+                        for channel in range(n_channels):
+                            result[row, col, channel] += weight * \
+                                padded[row + t_row, col + t_col, channel] * \
+                                padded[row + t_row, col + t_col, channel]
+                            result[row + t_row, col + t_col, channel] += \
+                                weight * padded[row, col, channel] * \
+                                padded[row, col, channel]
+
+        # Normalize pixel values using sum of weights of contributing patches
+        # and remove the Rician bias
+        for row in range(pad_size, n_row - pad_size):
+            for col in range(pad_size, n_col - pad_size):
+                for channel in range(n_channels):
+                    # No risk of division by zero, since the contribution
+                    # of a null shift is strictly positive
+                    result[row, col, channel] = (result[row, col, channel] /
+                                                 weights[row, col] -
+                                                 var * var)**0.5
+
+    # Return cropped result, undoing padding
+    return np.squeeze(np.asarray(result[pad_size:-pad_size,
+                                        pad_size:-pad_size]))
+
+def _RICE_fast_nl_means_denoising_3d(np_floats [:, :, ::1] padded,
+                                     Py_ssize_t s, Py_ssize_t d,
+                                     double h, double var):
+    """
+    Perform fast non-local means denoising on 3-D array, with the outer
+    loop on patch shifts in order to reduce the number of operations.
+    Parameters
+    ----------
+    padded : ndarray
+        3-D input data to be denoised, padded by ``s // 2 + d + 1`` on
+        every side.
+    s : Py_ssize_t, optional
+        Size of patches used for denoising.
+    d : Py_ssize_t, optional
+        Maximal distance in pixels where to search patches used for denoising.
+    h : np_floats, optional
+        Cut-off distance (in gray levels). The higher h, the more permissive
+        one is in accepting patches.
+    var : np_floats
+        Expected noise variance.  If non-zero, this is used to reduce the
+        apparent patch distances by the expected distance due to the noise.
+    Notes
+    -----
+    The weighted average accumulates the squared intensities, and the
+    result is corrected by the Rician bias as in the classic kernel.
+    Returns
+    -------
+    result : ndarray
+        Denoised image, of same shape as the unpadded input image.
+    """
+    if s % 2 == 0:
+        s += 1  # odd value for symmetric patch
+
+    cdef Py_ssize_t offset = s / 2
+    # Image padding: we need to account for patch size, possible shift,
+    # + 1 for the boundary effects in finite differences
+    cdef Py_ssize_t pad_size = offset + d + 1
+    padded_array = np.asarray(padded)
+    cdef np_floats [:, :, ::1] result = np.zeros_like(padded_array)
+    cdef np_floats [:, :, ::1] weights = np.zeros_like(padded_array)
+    cdef double [:, :, ::1] integral = np.zeros(padded_array.shape,
+                                                dtype=np.float64)
+    cdef Py_ssize_t n_pln, n_row, n_col
+    cdef Py_ssize_t t_pln, t_row, t_col, pln, row, col
+    cdef Py_ssize_t pln_dist_min, pln_dist_max, row_dist_min, row_dist_max
+    cdef Py_ssize_t col_dist_max
+    cdef np_floats DISTANCE_CUTOFF = 5.0
+    cdef np_floats weight, distance, alpha
+    n_pln, n_row, n_col = padded.shape[0], padded.shape[1], padded.shape[2]
+    cdef np_floats s_cube_h_square = h * h * s * s * s
+    var *= 2
+
+    with nogil:
+        # Outer loops on patch shifts
+        # With t_col >= 0, reference patch is always on the left of test patch
+        for t_pln in range(-d, d + 1):
+            pln_dist_min = max(offset + 1, offset + 1 - t_pln)
+            pln_dist_max = min(n_pln - offset - 1, n_pln - offset - 1 - t_pln)
+            for t_row in range(-d, d + 1):
+                row_dist_min = max(offset + 1, offset + 1 - t_row)
+                row_dist_max = min(n_row - offset - 1,
+                                   n_row - offset - 1 - t_row)
+                for t_col in range(0, d + 1):
+                    col_dist_max = n_col - offset - 1 - t_col
+                    # alpha is to account for patches on the same column
+                    # distance is computed twice in this case
+                    if t_col == 0:
+                        alpha = 0.5
+                    else:
+                        alpha = 1.
+                    _integral_image_3d[np_floats](padded, integral, t_pln,
+                                                  t_row, t_col, n_pln, n_row,
+                                                  n_col, var)
+
+                    # Inner loops on pixel coordinates
+                    for pln in range(pln_dist_min, pln_dist_max):
+                        for row in range(row_dist_min, row_dist_max):
+                            for col in range(offset + 1, col_dist_max):
+                                distance = _integral_to_distance_3d[np_floats](
+                                    integral, pln, row, col, offset,
+                                    s_cube_h_square)
+                                # exp of large negative numbers is close to 0
+                                if distance > DISTANCE_CUTOFF:
+                                    continue
+                                weight = alpha * _fast_exp(-distance)
+                                # Accumulate weights of the two patches
+                                weights[pln, row, col] += weight
+                                weights[pln + t_pln, row + t_row,
+                                        col + t_col] += weight
+                                # Rician mod: average the squared intensities
+                                result[pln, row, col] += weight * \
+                                    padded[pln + t_pln, row + t_row,
+                                           col + t_col] * \
+                                    padded[pln + t_pln, row + t_row,
+                                           col + t_col]
+                                result[pln + t_pln, row + t_row,
+                                       col + t_col] += weight * \
+                                    padded[pln, row, col] * \
+                                    padded[pln, row, col]
+
+        # Normalize pixel values using sum of weights of contributing patches
+        # and remove the Rician bias
+        for pln in range(pad_size, n_pln - pad_size):
+            for row in range(pad_size, n_row - pad_size):
+                for col in range(pad_size, n_col - pad_size):
+                    # No risk of division by zero, since the contribution
+                    # of a null shift is strictly positive
+                    result[pln, row, col] = (result[pln, row, col] /
+                                             weights[pln, row, col] -
+                                             var * var)**0.5
+
+    # Return cropped result, undoing padding
+    return np.asarray(result[pad_size:-pad_size,
+                             pad_size:-pad_size,
+                             pad_size:-pad_size])
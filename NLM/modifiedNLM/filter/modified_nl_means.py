@@ -1,12 +1,19 @@
+import os
 import numpy as np
+from functools import lru_cache
 from warnings import warn
 from .._shared.utils import convert_to_float
 from ._modified_nl_means import ( _RICE_nl_means_denoising_2d,
-                                 _RICE_nl_means_denoising_3d)
+                                 _RICE_nl_means_denoising_3d,
+                                 _RICE_blockwise_nl_means_denoising_3d,
+                                 _RICE_fast_nl_means_denoising_2d,
+                                 _RICE_fast_nl_means_denoising_3d)
 
 def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
                      multichannel=False, fast_mode=True, sigma=0., *,
-                     preserve_range=None):
+                     preserve_range=None, num_threads=1, dtype=None,
+                     method='voxelwise', block_step=2, preselect=False,
+                     preselect_thresholds=(0.95, 0.5)):
     """Perform non-local means denoising on 2-D or 3-D grayscale images, and
     2-D RGB images.
     Parameters
@@ -39,6 +46,33 @@ def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
         Whether to keep the original range of values. Otherwise, the input
         image is converted according to the conventions of `img_as_float`.
         Also see https://scikit-image.org/docs/dev/user_guide/data_types.html
+    num_threads : int, optional
+        Number of OpenMP threads used by the classic 3-D algorithm
+        (``fast_mode=False``), which shares the planes of the image among
+        them. If None, all the available cores are used. Other variants
+        of the algorithm run on a single thread.
+    dtype : {np.float32, np.float64}, optional
+        Floating point type used for the whole computation (conversion,
+        padding, weights and accumulation) and for the result. If None,
+        `float32` images are kept and other images use `float64`.
+    method : {'voxelwise', 'blockwise'}, optional
+        With 'blockwise', 3-D grayscale images are denoised with the
+        blockwise variant of the classic algorithm [5]_, which restores whole
+        patches on a grid spaced by `block_step` and averages them where they
+        overlap. `fast_mode` is then ignored, and `num_threads` shares the
+        planes of the grid.
+    block_step : int, optional
+        Distance between the centers of the restored blocks with
+        ``method='blockwise'``, between 1 and `patch_size`.
+    preselect : bool, optional
+        If True, the classic and blockwise 3-D algorithms only compute the
+        distance between two patches whose local means and variances are
+        close enough [6]_. Use `PaddedImage` to know the number of skipped
+        distances.
+    preselect_thresholds : tuple of 2 floats, optional
+        Lower bounds ``(mean_ratio, var_ratio)`` of the ratios of the means
+        and of the variances of two patches, whose inverses are the upper
+        bounds.
     Returns
     -------
     result : ndarray
@@ -61,7 +95,9 @@ def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
         image.size * patch_distance ** image.ndim
     The computing time depends only weakly on the patch size, thanks to
     the computation of the integral of patches distances for a given
-    shift, that reduces the number of operations [1]_. Therefore, this
+    shift, that reduces the number of operations [1]_. As in the classic
+    kernel, the weighted average is taken over the squared intensities and
+    the Rician bias is removed from the result. Therefore, this
     algorithm executes faster than the classic algorithm
     (``fast_mode=False``), at the expense of using twice as much memory.
     This implementation has been proven to be more efficient compared to
@@ -86,6 +122,33 @@ def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
     content and noise level, but a reasonable starting point is
     ``h = 0.8 * sigma`` when `fast_mode` is `True`, or ``h = 0.6 * sigma`` when
     `fast_mode` is `False`.
+    With ``dtype=np.float32`` the image, the patch weights and the weighted
+    sums take half the memory and memory bandwidth. Each output value is a
+    ratio of sums of at most ``(2 * patch_distance + 1) ** image.ndim``
+    terms, so its relative rounding error is bounded by that number times
+    the float32 epsilon (about 1.3e-4 for ``patch_distance=6`` in 3-D) and
+    is typically of the order of 1e-6. This is well below the error of the
+    approximate exponential used for the weights. The integral images of
+    the fast algorithm are always kept in float64, since their cumulative
+    sums grow with the image size.
+    The blockwise variant [5]_ computes the weighted average of whole
+    patches instead of their central voxel, only for the patches centered on
+    a grid spaced by `block_step`, so it evaluates about ``block_step ** 3``
+    times fewer patch distances than the classic algorithm, at the cost of
+    ``patch_size ** 3`` operations to accumulate each similar patch. Each
+    voxel takes the mean of the averaged squared intensities of the patches
+    covering it, and the Rician bias is then removed as in the classic
+    algorithm.
+    The pre-selection [6]_ computes the mean and variance of every patch
+    once, with separable box filters, and skips the distances to the
+    patches whose mean or variance differ too much from the ones of the
+    patch of interest. In images made mostly of two phases, such as pore and
+    rock, most patches of the other phase are skipped. Skipped patches are
+    given a zero weight, so the result differs from the one without
+    pre-selection only by the small weights of those dissimilar patches.
+    Since fewer patches are averaged, dark voxels whose averaged squared
+    intensity falls below the Rician correction, and which are then NaN as
+    in the classic algorithm, are slightly more frequent.
     References
     ----------
     .. [1] A. Buades, B. Coll, & J-M. Morel. A non-local algorithm for image
@@ -102,12 +165,67 @@ def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
     .. [4] A. Buades, B. Coll, & J-M. Morel. Non-Local Means Denoising.
            Image Processing On Line, 2011, vol. 1, pp. 208-212.
            :DOI:`10.5201/ipol.2011.bcm_nlm`
+    .. [5] P. Coupé, P. Yger, S. Prima, P. Hellier, C. Kervrann and C.
+           Barillot, An Optimized Blockwise Nonlocal Means Denoising Filter
+           for 3-D Magnetic Resonance Images, IEEE Transactions on Medical
+           Imaging, 2008, vol. 27, pp. 425-441.
+           :DOI:`10.1109/TMI.2007.906087`
+    .. [6] M. Mahmoudi and G. Sapiro, Fast image and video denoising via
+           nonlocal means of similar neighborhoods, IEEE Signal Processing
+           Letters, 2005, vol. 12, pp. 839-842.
+           :DOI:`10.1109/LSP.2005.859509`
     Examples
     --------
     >>> a = np.zeros((40, 40))
     >>> a[10:-10, 10:-10] = 1.
     >>> a += 0.3 * np.random.randn(*a.shape)
-    >>> denoised_a = denoise_nl_means(a, 7, 5, 0.1)
+    >>> denoised_a = rician_denoise_nl_means(a, 7, 5, 0.1)
+    """
+    image, multichannel = _as_float_image(image, multichannel,
+                                          preserve_range, dtype)
+    padded_image = PaddedImage(image, patch_size, patch_distance,
+                               multichannel, fast_mode, preserve_range=True,
+                               method=method, block_step=block_step)
+    return padded_image.denoise(h, sigma, num_threads=num_threads,
+                                preselect=preselect,
+                                preselect_thresholds=preselect_thresholds)
+
+
+@lru_cache(maxsize=16)
+def _gaussian_patch_kernel(patch_size, ndim, dtype):
+    """Unnormalized Gaussian weights of the patch pixels used by the classic
+    algorithm. The returned array is cached and read-only.
+    Parameters
+    ----------
+    patch_size : int
+        Odd size of the patches.
+    ndim : int
+        Number of spatial dimensions of the patches.
+    dtype : np.dtype
+        Floating point type of the weights.
+    Returns
+    -------
+    kernel : ndarray
+        Weights of shape ``(patch_size,) * ndim``.
+    """
+    offset = patch_size // 2
+    A = dtype.type((patch_size - 1.) / 4.)
+    range_vals = np.arange(-offset, offset + 1, dtype=dtype)
+    grids = np.meshgrid(*(range_vals,) * ndim, indexing='ij')
+    kernel = np.ascontiguousarray(
+        np.exp(-sum(grid * grid for grid in grids) / (2 * A * A)))
+    kernel.setflags(write=False)
+    return kernel
+
+
+def _as_float_image(image, multichannel, preserve_range, dtype):
+    """Check the dimensions of the input image and convert it to float.
+    Returns
+    -------
+    image : ndarray
+        3-D float image, with a channel axis for 2-D images.
+    multichannel : bool
+        Whether the last axis of ``image`` holds channels.
     """
     if image.ndim == 2:
         image = image[..., np.newaxis]
@@ -122,22 +240,296 @@ def rician_denoise_nl_means(image, patch_size=7, patch_distance=11, h=0.1,
              '(preserve_range=True). In scikit-image 0.19 this behavior will '
              'change to preserve_range=False. To avoid this warning, '
              'explicitly specify the preserve_range parameter.',
-             stacklevel=2)
+             stacklevel=3)
         preserve_range = True
 
-    image = convert_to_float(image, preserve_range)
+    image = convert_to_float(image, preserve_range, dtype)
+    return image, multichannel
 
-    kwargs = dict(s=patch_size, d=patch_distance, h=h, var=sigma * sigma)
-    if multichannel:  # 2-D images
-        if fast_mode:
-#            return _fast_nl_means_denoising_2d(image, **kwargs)
-            return 'not implemented'
-        else:
-            return _RICE_nl_means_denoising_2d(image, **kwargs)
-    else:  # 3-D grayscale
+
+class PaddedImage:
+    """Image converted and padded once for non-local means denoising, so that
+    it can be denoised several times, e.g. in a sweep over `h` or `sigma`,
+    without converting, padding and copying the image again.
+    Parameters
+    ----------
+    image : 2D or 3D ndarray
+        Input image to be denoised. See `rician_denoise_nl_means`.
+    patch_size : int, optional
+        Size of patches used for denoising.
+    patch_distance : int, optional
+        Maximal distance in pixels where to search patches used for denoising.
+    multichannel : bool, optional
+        Whether the last axis of the image is to be interpreted as multiple
+        channels or another spatial dimension.
+    fast_mode : bool, optional
+        If True (default value), a fast version of the non-local means
+        algorithm is used, which needs a wider padding.
+    preserve_range : bool, optional
+        Whether to keep the original range of values.
+    dtype : {np.float32, np.float64}, optional
+        Floating point type used for the computation.
+    method : {'voxelwise', 'blockwise'}, optional
+        Variant of the algorithm, see `rician_denoise_nl_means`.
+    block_step : int, optional
+        Distance between the centers of the restored blocks with
+        ``method='blockwise'``.
+    Attributes
+    ----------
+    padded : ndarray
+        Reflect-padded, C-contiguous copy of the float image.
+    n_candidates : int
+        Number of patch distances of the last call to `denoise` without
+        pre-selection.
+    n_skipped : int
+        Number of patch distances skipped by the pre-selection in the last
+        call to `denoise`.
+    Examples
+    --------
+    >>> padded_image = PaddedImage(a, 5, 6, fast_mode=False)
+    >>> results = [padded_image.denoise(h) for h in (0.8, 1.0, 1.2)]
+    """
+
+    def __init__(self, image, patch_size=7, patch_distance=11,
+                 multichannel=False, fast_mode=True, *, preserve_range=None,
+                 dtype=None, method='voxelwise', block_step=2):
+        if method not in ('voxelwise', 'blockwise'):
+            raise ValueError("method must be 'voxelwise' or 'blockwise'.")
+        image, multichannel = _as_float_image(image, multichannel,
+                                              preserve_range, dtype)
+        if method == 'blockwise':
+            if multichannel:
+                raise NotImplementedError("Blockwise denoising is only "
+                                          "implemented for 3-D grayscale "
+                                          "images.")
+            fast_mode = False
+        # odd value for symmetric patch
+        self.patch_size = patch_size + 1 if patch_size % 2 == 0 else patch_size
+        self.patch_distance = patch_distance
+        self.multichannel = multichannel
+        self.fast_mode = fast_mode
+        self.method = method
+        self.block_step = block_step
+        self.n_candidates = None
+        self.n_skipped = 0
+        self._local_statistics = None
+
+        pad_size = self.patch_size // 2
         if fast_mode:
-#            return _fast_nl_means_denoising_3d(image, **kwargs)
-            return 'not implemented'
+            # we need to account for patch size, possible shift,
+            # + 1 for the boundary effects in finite differences
+            pad_size += patch_distance + 1
+        if multichannel:
+            pad_width = ((pad_size, pad_size), (pad_size, pad_size), (0, 0))
         else:
-            return _RICE_nl_means_denoising_3d(image, **kwargs)
+            pad_width = pad_size
+        self.padded = np.ascontiguousarray(np.pad(image, pad_width,
+                                                  mode='reflect'))
+
+    def denoise(self, h=0.1, sigma=0., num_threads=1, preselect=False,
+                preselect_thresholds=(0.95, 0.5)):
+        """Denoise the image. See `rician_denoise_nl_means`.
+        Parameters
+        ----------
+        h : float, optional
+            Cut-off distance (in gray levels).
+        sigma : float, optional
+            The standard deviation of the (Gaussian) noise.
+        num_threads : int, optional
+            Number of OpenMP threads used by the classic and blockwise 3-D
+            algorithms.
+        preselect : bool, optional
+            Whether to skip the distances to dissimilar patches. The local
+            statistics of the patches are computed at the first call and
+            kept for the next ones.
+        preselect_thresholds : tuple of 2 floats, optional
+            Lower bounds of the ratios of the means and of the variances.
+        Returns
+        -------
+        result : ndarray
+            Denoised image, of same shape as the input image.
+        """
+        if num_threads is None:
+            num_threads = os.cpu_count()
+
+        kwargs = dict(s=self.patch_size, d=self.patch_distance,
+                      var=sigma * sigma)
+        self.n_skipped = 0
+        if preselect:
+            if self.fast_mode or self.multichannel:
+                raise NotImplementedError("Pre-selection is only implemented "
+                                          "for the classic and blockwise 3-D "
+                                          "algorithms.")
+            if self._local_statistics is None:
+                self._local_statistics = _local_mean_variance(
+                    self.padded, self.patch_size)
+            kwargs.update(means=self._local_statistics[0],
+                          variances=self._local_statistics[1],
+                          mean_ratio=preselect_thresholds[0],
+                          var_ratio=preselect_thresholds[1])
+        if self.fast_mode:
+            if self.multichannel:  # 2-D images
+                return _RICE_fast_nl_means_denoising_2d(self.padded, h=h,
+                                                        **kwargs)
+            else:  # 3-D grayscale
+                return _RICE_fast_nl_means_denoising_3d(self.padded, h=h,
+                                                        **kwargs)
+
+        n_channels = self.padded.shape[2] if self.multichannel else 1
+        ndim = 2 if self.multichannel else 3
+        kernel = _gaussian_patch_kernel(self.patch_size, ndim,
+                                        self.padded.dtype)
+        w = kernel * (1. / (n_channels * np.sum(kernel) * h * h))
+        if self.multichannel:  # 2-D images
+            return _RICE_nl_means_denoising_2d(self.padded, w=w, **kwargs)
+        elif self.method == 'blockwise':
+            result = _RICE_blockwise_nl_means_denoising_3d(
+                self.padded, w=w.ravel(), step=self.block_step,
+                num_threads=num_threads, **kwargs)
+            centers = [_block_centers(n, self.block_step, self.patch_size)
+                       for n in result[0].shape] if preselect else None
+        else:  # 3-D grayscale
+            result = _RICE_nl_means_denoising_3d(self.padded, w=w.ravel(),
+                                                 num_threads=num_threads,
+                                                 **kwargs)
+            centers = None
+        if not preselect:
+            return result
+
+        result, self.n_skipped = result
+        if centers is None:
+            centers = [np.arange(n) for n in result.shape]
+        self.n_candidates = _n_candidates(result.shape, centers,
+                                          self.patch_distance)
+        return result
+
+
+def _local_mean_variance(padded, patch_size):
+    """Mean and variance of the patch centered on each voxel of a 3-D image
+    padded by ``patch_size // 2``, computed with separable box filters.
+    """
+    sums = padded.astype(np.float64)
+    squares = sums * sums
+    for axis in range(3):
+        sums = _box_sum(sums, patch_size, axis)
+        squares = _box_sum(squares, patch_size, axis)
+    means = sums / patch_size ** 3
+    variances = np.maximum(squares / patch_size ** 3 - means * means, 0)
+    return (np.ascontiguousarray(means, dtype=padded.dtype),
+            np.ascontiguousarray(variances, dtype=padded.dtype))
+
+
+def _box_sum(array, size, axis):
+    """Sums of `size` consecutive values along `axis`, from a cumulative
+    sum. The output is shorter than `array` by ``size - 1`` along `axis`.
+    """
+    cumsum = np.cumsum(array, axis=axis)
+    zeros = np.zeros_like(np.take(cumsum, [0], axis=axis))
+    cumsum = np.concatenate([zeros, cumsum], axis=axis)
+    n = cumsum.shape[axis]
+    return (np.take(cumsum, np.arange(size, n), axis=axis) -
+            np.take(cumsum, np.arange(n - size), axis=axis))
+
+
+def _block_centers(n, step, patch_size):
+    """Centers of the blockwise grid along an axis of length `n`."""
+    centers = np.arange(0, n, step)
+    if (n - 1) % step > patch_size // 2:
+        centers = np.append(centers, n - 1)
+    return centers
+
+
+def _n_candidates(shape, centers, patch_distance):
+    """Number of patch distances computed without pre-selection for the
+    patches centered on the grid ``centers`` of an image of shape `shape`.
+    """
+    n_candidates = 1
+    for n, axis_centers in zip(shape, centers):
+        n_candidates *= int(np.sum(np.minimum(patch_distance, axis_centers) +
+                                   np.minimum(patch_distance + 1,
+                                              n - axis_centers)))
+    return n_candidates
+
+
+def rician_denoise_nl_means_slabs(image, output=None, slab_size=32,
+                                  patch_size=7, patch_distance=11, h=0.1,
+                                  fast_mode=True, sigma=0., *,
+                                  preserve_range=None, num_threads=1,
+                                  dtype=None):
+    """Perform non-local means denoising on a 3-D grayscale image, one slab
+    of planes at a time.
+    Parameters
+    ----------
+    image : 3D array_like
+        Input image to be denoised. Only ``image.shape`` and slicing along the
+        first axis are used, so a memory-mapped array or a lazy proxy to an
+        image file can be given and the volume is never loaded at once.
+    output : 3D array_like, optional
+        Array receiving the denoised image, e.g. a memory-mapped output file.
+        If None, an array is allocated.
+    slab_size : int, optional
+        Number of planes denoised at each step.
+    patch_size : int, optional
+        Size of patches used for denoising.
+    patch_distance : int, optional
+        Maximal distance in pixels where to search patches used for denoising.
+    h : float, optional
+        Cut-off distance (in gray levels). See `rician_denoise_nl_means`.
+    fast_mode : bool, optional
+        If True (default value), a fast version of the non-local means
+        algorithm is used. If False, the original version of non-local means is
+        used.
+    sigma : float, optional
+        The standard deviation of the (Gaussian) noise.
+    preserve_range : bool, optional
+        Whether to keep the original range of values. Otherwise, the input
+        image is converted according to the conventions of `img_as_float`.
+    num_threads : int, optional
+        Number of OpenMP threads used by the classic algorithm.
+    dtype : {np.float32, np.float64}, optional
+        Floating point type used for the computation.
+    Returns
+    -------
+    output : ndarray
+        Denoised image, of same shape as `image`.
+    Notes
+    -----
+    Each slab is read with a halo of ``patch_distance + patch_size // 2``
+    planes on both sides, which holds every patch compared to a voxel of the
+    slab. The interior of the denoised slab is then equal to the result of
+    `rician_denoise_nl_means` on the whole image: bit-identical for
+    ``fast_mode=False``, and up to the rounding of the integral images for
+    ``fast_mode=True``.
+    """
+    if len(image.shape) != 3:
+        raise NotImplementedError("Slab denoising is only implemented for "
+                                  "3-D grayscale images.")
+
+    if preserve_range is None and np.issubdtype(image.dtype, np.integer):
+        warn('Image dtype is not float. By default denoise_nl_means will '
+             'assume you want to preserve the range of your image '
+             '(preserve_range=True). To avoid this warning, '
+             'explicitly specify the preserve_range parameter.',
+             stacklevel=2)
+        preserve_range = True
+
+    s = patch_size + 1 if patch_size % 2 == 0 else patch_size
+    halo = patch_distance + s // 2
+    n_pln = image.shape[0]
+
+    for start in range(0, n_pln, slab_size):
+        stop = min(start + slab_size, n_pln)
+        slab_start = max(start - halo, 0)
+        slab_stop = min(stop + halo, n_pln)
+
+        denoised = rician_denoise_nl_means(
+            np.asarray(image[slab_start:slab_stop]), patch_size,
+            patch_distance, h, multichannel=False, fast_mode=fast_mode,
+            sigma=sigma, preserve_range=preserve_range,
+            num_threads=num_threads, dtype=dtype)
+
+        if output is None:
+            output = np.empty(image.shape, dtype=denoised.dtype)
+        output[start:stop] = denoised[start - slab_start:stop - slab_start]
 
+    return output
@@ -0,0 +1,165 @@
+import os
+import itertools
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from warnings import warn
+from .._shared.utils import convert_to_float
+from .modified_nl_means import rician_denoise_nl_means
+
+
+def denoise_tiled(image, tile_shape=64, halo=None, workers=None,
+                  patch_size=7, patch_distance=11, h=0.1, fast_mode=True,
+                  sigma=0., *, preserve_range=None, dtype=None):
+    """Perform non-local means denoising on a 3-D grayscale image, with
+    overlapping tiles denoised in parallel processes.
+    Parameters
+    ----------
+    image : 3D ndarray
+        Input image to be denoised.
+    tile_shape : int or tuple of 3 ints, optional
+        Shape of the tile interiors. The last tiles along each axis are
+        smaller when the image shape is not a multiple of `tile_shape`.
+    halo : int, optional
+        Number of voxels read around each tile interior. Defaults to
+        ``patch_distance + patch_size // 2``, the smallest halo holding every
+        patch compared to a voxel of the interior.
+    workers : int, optional
+        Number of worker processes. If None, ``os.cpu_count()`` is used. With
+        one worker the tiles are denoised in the calling process.
+    patch_size : int, optional
+        Size of patches used for denoising.
+    patch_distance : int, optional
+        Maximal distance in pixels where to search patches used for denoising.
+    h : float, optional
+        Cut-off distance (in gray levels). See `rician_denoise_nl_means`.
+    fast_mode : bool, optional
+        If True (default value), a fast version of the non-local means
+        algorithm is used. If False, the original version of non-local means is
+        used.
+    sigma : float, optional
+        The standard deviation of the (Gaussian) noise.
+    preserve_range : bool, optional
+        Whether to keep the original range of values. Otherwise, the input
+        image is converted according to the conventions of `img_as_float`.
+    dtype : {np.float32, np.float64}, optional
+        Floating point type used for the computation.
+    Returns
+    -------
+    result : ndarray
+        Denoised image, of same shape as `image`.
+    Notes
+    -----
+    The image is converted to float once, then the converted image and the
+    result are placed in `multiprocessing.shared_memory` blocks: the workers
+    read their tile and write its interior in place, so only the tile bounds
+    are pickled. With the default halo the result is equal to the one of
+    `rician_denoise_nl_means` on the whole image: bit-identical for
+    ``fast_mode=False``, and up to the rounding of the integral images for
+    ``fast_mode=True``.
+    Each worker runs a single OpenMP thread, so `workers` should not exceed
+    the number of cores.
+    """
+    if image.ndim != 3:
+        raise NotImplementedError("Tiled denoising is only implemented for "
+                                  "3-D grayscale images.")
+
+    if preserve_range is None and np.issubdtype(image.dtype, np.integer):
+        warn('Image dtype is not float. By default denoise_nl_means will '
+             'assume you want to preserve the range of your image '
+             '(preserve_range=True). To avoid this warning, '
+             'explicitly specify the preserve_range parameter.',
+             stacklevel=2)
+        preserve_range = True
+    image = convert_to_float(image, preserve_range, dtype)
+
+    s = patch_size + 1 if patch_size % 2 == 0 else patch_size
+    min_halo = patch_distance + s // 2
+    if halo is None:
+        halo = min_halo
+    elif halo < min_halo:
+        warn('A halo smaller than patch_distance + patch_size // 2 = %d '
+             'changes the result near the tile borders.' % min_halo,
+             stacklevel=2)
+    if np.isscalar(tile_shape):
+        tile_shape = (int(tile_shape),) * 3
+    if workers is None:
+        workers = os.cpu_count()
+
+    tiles = _tile_bounds(image.shape, tile_shape)
+    kwargs = dict(patch_size=patch_size, patch_distance=patch_distance, h=h,
+                  fast_mode=fast_mode, sigma=sigma)
+
+    if workers == 1 or len(tiles) == 1:
+        result = np.empty_like(image)
+        for bounds in tiles:
+            _denoise_tile(image, result, bounds, halo, kwargs)
+        return result
+
+    shm_in = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    shm_out = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    shared_image = None
+    try:
+        shared_image = np.ndarray(image.shape, image.dtype, buffer=shm_in.buf)
+        shared_image[...] = image
+        in_spec = (shm_in.name, image.shape, image.dtype.str)
+        out_spec = (shm_out.name, image.shape, image.dtype.str)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_shared_tile_worker, in_spec, out_spec,
+                                       bounds, halo, kwargs)
+                       for bounds in tiles]
+            for future in futures:
+                future.result()
+        result = np.array(np.ndarray(image.shape, image.dtype,
+                                     buffer=shm_out.buf))
+    finally:
+        # The views must be released before close(), or it raises
+        # BufferError and hides the exception of a worker
+        del shared_image
+        for shm in (shm_in, shm_out):
+            shm.close()
+            shm.unlink()
+
+    return result
+
+
+def _tile_bounds(shape, tile_shape):
+    """List of ``((start, stop), ...)`` interior bounds of the tiles."""
+    ranges = [[(start, min(start + tile, size))
+               for start in range(0, size, tile)]
+              for size, tile in zip(shape, tile_shape)]
+    return list(itertools.product(*ranges))
+
+
+def _denoise_tile(image, result, bounds, halo, kwargs):
+    """Denoise one tile with its halo and write its interior into `result`."""
+    read = tuple(slice(max(start - halo, 0), min(stop + halo, size))
+                 for (start, stop), size in zip(bounds, image.shape))
+    interior = tuple(slice(start - r.start, stop - r.start)
+                     for (start, stop), r in zip(bounds, read))
+    denoised = rician_denoise_nl_means(image[read], multichannel=False,
+                                       preserve_range=True, num_threads=1,
+                                       dtype=image.dtype, **kwargs)
+    result[tuple(slice(start, stop) for start, stop in bounds)] = \
+        denoised[interior]
+
+
+def _shared_tile_worker(in_spec, out_spec, bounds, halo, kwargs):
+    """Attach to the shared input and output images and denoise one tile."""
+    shm_in = shared_memory.SharedMemory(name=in_spec[0])
+    shm_out = shared_memory.SharedMemory(name=out_spec[0])
+    image = result = None
+    try:
+        image = np.ndarray(in_spec[1], np.dtype(in_spec[2]), buffer=shm_in.buf)
+        result = np.ndarray(out_spec[1], np.dtype(out_spec[2]),
+                            buffer=shm_out.buf)
+        _denoise_tile(image, result, bounds, halo, kwargs)
+    except BaseException as error:
+        # The frames of the traceback also hold views of the shared buffers
+        traceback.clear_frames(error.__traceback__)
+        raise
+    finally:
+        del image, result
+        shm_in.close()
+        shm_out.close()
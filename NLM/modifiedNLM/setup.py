@@ -3,7 +3,9 @@
 import io
 import os
 import re
+import sys
 
+from setuptools import Extension
 from setuptools import find_packages
 from setuptools import setup
 from Cython.Build import cythonize
@@ -16,6 +18,22 @@ def read(filename):
         return re.sub(text_type(r':[a-z]+:`~?(.*?)`'), text_type(r'``\1``'), fd.read())
 
 
+# OpenMP is used by the prange loop of the 3D non-local means kernel
+if sys.platform == 'win32':
+    openmp_flags = ['/openmp']
+    openmp_link_flags = []
+else:
+    openmp_flags = ['-fopenmp']
+    openmp_link_flags = ['-fopenmp']
+
+extensions = [
+    Extension("filter._modified_nl_means",
+              ["filter/_modified_nl_means.pyx"],
+              extra_compile_args=openmp_flags,
+              extra_link_args=openmp_link_flags),
+]
+
+
 setup(
     name="modifiedNLM",
     version="0.1.0",
@@ -45,6 +63,6 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
 
-    ext_modules = cythonize("filter/_modified_nl_means.pyx"),
+    ext_modules = cythonize(extensions),
     include_dirs=[numpy.get_include()]
 )
@@ -1,13 +1,163 @@
 #Author: Gustavo Solcia
 #E-mail: gustavo.solcia@usp.br
 
-"""Import stl from boundary surface and save boundary points coordinates.
+"""Import stl from boundary surface and save boundary points coordinates, or the distance from
+each inlet face centre to the nearest boundary point for the flowRatePoiseuilleVelocity BC.
+
+Usage:
+    python saveCoord.py stlRecon/wall.stl --points boundaryPoints
+    python saveCoord.py stlRecon/wall.stl --centres 0/C --patch inlet --output inletWallDistance
+
+The second form writes a wallDistance entry to include in the inlet patch of 0/U:
+
+    inlet
+    {
+        type                flowRatePoiseuilleVelocity;
+        volumetricFlowRate  1e-6;
+        #include            "inletWallDistance"
+        value               uniform (0 0 0);
+    }
+
+so the BC does not search the boundary points at all. The face centres come from the C field of
+'postProcess -func writeCellCentres' or from the foamToVTK file of the inlet patch (.vtk or .vtp).
 """
-import csv
+import re
+import argparse
 import numpy as np
-from stl import mesh
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import proj3d
+from scipy.spatial import cKDTree
+
+def read_boundary_points(stl_path):
+    """
+    Unique vertices of a boundary surface.
+
+    Parameter
+    ---------
+    stl_path: string
+        Path to the boundary surface in stl format.
+
+    Returns
+    -------
+    points: array
+        (N, 3) array of the unique vertices.
+    """
+    from stl import mesh
+
+    surfaceMesh = mesh.Mesh.from_file(stl_path)
+    shape = np.shape(surfaceMesh.vectors)
+    points = np.unique(surfaceMesh.vectors.reshape([shape[0]*3,3]), axis=0)
+
+    return points
+
+def write_boundary_points(path, points):
+    """
+    Write the boundary points as an OpenFOAM List<vector>, read by the BC when there is no
+    wallDistance entry.
+
+    Parameter
+    ---------
+    path: string
+        Output file (e.g. boundaryPoints in the case directory).
+    points: array
+        (N, 3) array of points.
+    """
+    with open(path, 'w', encoding='UTF8') as f:
+        f.write(str(len(points))+'\n')
+        f.write('('+'\n')
+        np.savetxt(f, points, fmt='(%.9g %.9g %.9g)')
+        f.write(')'+'\n')
+
+def read_face_centres(path, patch='inlet'):
+    """
+    Face centres of a patch, in the face order of the mesh.
+
+    Parameter
+    ---------
+    path: string
+        C field from 'postProcess -func writeCellCentres' (ascii format), or foamToVTK file of
+        the patch (.vtk or .vtp).
+    patch: string
+        Patch name in the C field.
+
+    Returns
+    -------
+    centres: array
+        (N, 3) array of the face centres.
+    """
+    if path.endswith('.vtk') or path.endswith('.vtp'):
+        import vtk
+        from vtk.util import numpy_support
+
+        reader = vtk.vtkXMLPolyDataReader() if path.endswith('.vtp') else vtk.vtkPolyDataReader()
+        reader.SetFileName(path)
+        cellCenters = vtk.vtkCellCenters()
+        cellCenters.SetInputConnection(reader.GetOutputPort())
+        cellCenters.Update()
+
+        return numpy_support.vtk_to_numpy(cellCenters.GetOutput().GetPoints().GetData()).astype(float)
+
+    with open(path) as f:
+        text = f.read()
+    patch_start = re.search(r'\bboundaryField\b.*?\b%s\s*\{' % re.escape(patch), text, re.S)
+    if patch_start is None:
+        raise ValueError('Patch %s not found in %s.' % (patch, path))
+    # search the value only inside the {...} block of the patch
+    depth = 1
+    patch_end = patch_start.end()
+    while depth and patch_end < len(text):
+        if text[patch_end] == '{':
+            depth += 1
+        elif text[patch_end] == '}':
+            depth -= 1
+        patch_end += 1
+    value = re.compile(r'\bvalue\s+nonuniform\s+List<vector>\s*(\d+)\s*\(').search(text, patch_start.end(), patch_end)
+    if value is None:
+        raise ValueError('No ascii nonuniform value for patch %s in %s (a uniform value has no per face'
+                         ' centres, use the foamToVTK file of the patch instead).' % (patch, path))
+
+    number_of_faces = int(value.group(1))
+    values = text[value.end():text.index(';', value.end())]
+    centres = np.array(values.replace('(', ' ').replace(')', ' ').split(), dtype=float)
+
+    return centres[:3*number_of_faces].reshape(number_of_faces, 3)
+
+def compute_wall_distance(centres, points):
+    """
+    Distance from each face centre to the nearest boundary point with a k-d tree.
+
+    Parameter
+    ---------
+    centres: array
+        (N, 3) array of the face centres.
+    points: array
+        (M, 3) array of the boundary points.
+
+    Returns
+    -------
+    distances: array
+        (N,) array of distances.
+    """
+    distances, _ = cKDTree(points).query(centres)
+
+    return distances
+
+def write_wall_distance(path, distances):
+    """
+    Write the wallDistance entry of the inlet patch as a nonuniform List<scalar>.
+
+    Parameter
+    ---------
+    path: string
+        Output file, included in the inlet patch dictionary of 0/U.
+    distances: array
+        (N,) array of distances in the face order of the patch.
+    """
+    with open(path, 'w', encoding='UTF8') as f:
+        f.write('wallDistance nonuniform List<scalar>\n')
+        f.write(str(len(distances))+'\n')
+        f.write('('+'\n')
+        np.savetxt(f, distances, fmt='%.9g')
+        f.write(')'+'\n')
+        f.write(';'+'\n')
 
 def visualize_boundaryPoints(points):
     """
@@ -18,6 +168,9 @@ def visualize_boundaryPoints(points):
     points: array
         Points from given boundary file in stl format.
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import proj3d
+
     fig = plt.figure(figsize=(8, 8))
     ax = fig.add_subplot(111, projection='3d')
     ax.scatter(points[:,0], points[:,1], points[:,2], color='k')
@@ -26,16 +179,25 @@ def visualize_boundaryPoints(points):
 
 if __name__=='__main__':
 
-    surfaceMesh = mesh.Mesh.from_file('stlRecon/IXI160-LICA.stl')
-    shape = np.shape(surfaceMesh.vectors)
-    points = np.unique(surfaceMesh.vectors.reshape([shape[0]*3,3]), axis=0)
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('stl', help='boundary surface (wall) in stl format')
+    parser.add_argument('--points', default=None, help='write the boundary points to this file')
+    parser.add_argument('--centres', default=None,
+                        help='C field or foamToVTK file with the inlet face centres')
+    parser.add_argument('--patch', default='inlet', help='inlet patch name in the C field')
+    parser.add_argument('--output', default='inletWallDistance',
+                        help='wallDistance entry file written with --centres')
+    parser.add_argument('--show', action='store_true', help='plot the boundary points')
+    args = parser.parse_args()
+
+    points = read_boundary_points(args.stl)
+
+    if args.points is not None:
+        write_boundary_points(args.points, points)
 
-    f = open('boundaryPoints_LICA','w', encoding='UTF8')
-    f.write(str(len(points))+'\n')
-    f.write('('+'\n')
-    for point in points:
-        f.write('('+str(point[0])+' '+str(point[1])+' '+str(point[2])+')'+'\n')
-    f.write(')'+'\n')
-    f.close()
+    if args.centres is not None:
+        centres = read_face_centres(args.centres, args.patch)
+        write_wall_distance(args.output, compute_wall_distance(centres, points))
 
-    visualize_boundaryPoints(points)
+    if args.show:
+        visualize_boundaryPoints(points)